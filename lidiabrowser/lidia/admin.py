@@ -1,8 +1,13 @@
 from typing import List, Type
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
 from django.http import HttpRequest
 from django.utils.html import format_html_join, format_html
 
+from sync.pagination import CachedCountAdminMixin, CachedCountChangeList
+
+from . import search
+from .facets import FACET_FILTERS
 from .models import (
     Annotation,
     ArticleTerm,
@@ -12,6 +17,7 @@ from .models import (
     Language,
     TermGroup,
     Category,
+    get_page_range,
 )
 
 
@@ -31,13 +37,25 @@ class TermGroupInline(admin.TabularInline):
     extra = 0
 
 
-class AnnotationAdmin(admin.ModelAdmin):
+class AnnotationChangeList(CachedCountChangeList):
+    def get_ordering(self, request: HttpRequest, queryset):
+        ordering = super().get_ordering(request, queryset)
+        if "search_rank" in queryset.query.annotations and \
+                ORDER_VAR not in self.params:
+            # Best matches of a full-text search first, unless the user
+            # chose the order
+            return ["search_rank", *ordering]
+        return ordering
+
+
+class AnnotationAdmin(CachedCountAdminMixin, admin.ModelAdmin):
     list_display = ["parent_attachment_display", "argname_display", "description", "arglang", "page_range_complete",
-                    "summary_of_term_groups", "relation_display"]
+                    "terms", "relation_display"]
     list_display_links = ["argname_display"]
-    list_filter = ["parent_attachment", "arglang", "termgroups__articleterm__term", "termgroups__lidiaterm__term",
-                   "termgroups__category__category"]
-    ordering = ("parent_attachment", "sort_index")
+    list_filter = FACET_FILTERS
+    ordering = ("parent_attachment", "sort_index", "id")
+    # Deep pages of the default ordering are fetched without OFFSET
+    keyset = ordering
     inlines = [
         ContinuationInline,
         TermGroupInline,
@@ -61,16 +79,19 @@ class AnnotationAdmin(admin.ModelAdmin):
         qs = super().get_queryset(request)
         # Use select_related for ForeignKey fields accessed in list_display
         qs = qs.select_related('parent_attachment', 'arglang', 'relation_to')
-        # Use prefetch_related for reverse ForeignKey (termgroups, continuation_annotations)
-        # and their nested relations
-        qs = qs.prefetch_related(
-            'termgroups__articleterm',
-            'termgroups__lidiaterm',
-            'termgroups__category',
-            'continuation_annotations',
-        )
+        # The terms, quotation and page range in the PDF are stored by
+        # populate, so no term groups or continuation annotations are needed
         return qs
 
+    def get_search_results(self, request: HttpRequest, queryset, search_term: str):
+        """Search the full-text index if available, ranking the results."""
+        if not search_term or not search.is_available():
+            return super().get_search_results(request, queryset, search_term)
+        return search.search(queryset, search_term), False
+
+    def get_changelist(self, request: HttpRequest, **kwargs):
+        return AnnotationChangeList
+
     @admin.display(
         ordering="argname",
         description="name",
@@ -100,6 +121,11 @@ class AnnotationAdmin(admin.ModelAdmin):
     def relation_display(self, obj: Annotation):
         if not obj.relation_type:
             return None
+        if obj.relation_to is None and obj.relation_to_lidia_id:
+            return (
+                f"{obj.get_relation_type_display()} "
+                f"{obj.relation_to_lidia_id} (missing)"
+            )
         return f"{obj.get_relation_type_display()} {obj.relation_to}"
 
     @admin.display(
@@ -107,7 +133,8 @@ class AnnotationAdmin(admin.ModelAdmin):
         ordering="page_start"
     )
     def page_range_complete(self, obj: Annotation):
-        return f"{obj.page_range} ({obj.page_range_in_pdf})"
+        page_range_in_pdf = get_page_range(obj.pdf_page_start, obj.pdf_page_end)
+        return f"{obj.page_range} ({page_range_in_pdf})"
 
     def get_fieldsets(self, request: HttpRequest, obj=None):
         fieldsets = [
@@ -128,6 +155,7 @@ class AnnotationAdmin(admin.ModelAdmin):
                     "fields": [
                         "relation_type",
                         "relation_to",
+                        "relation_to_lidia_id",
                     ],
                 }
             ), (
@@ -168,6 +196,7 @@ class LidiaTermAdmin(admin.ModelAdmin):
     list_display = ["term", "vocab", "formatted_urls"]
     list_filter = ["vocab"]
     fields = ["term", "vocab", "formatted_urls"]
+    readonly_fields = ["formatted_urls"]  # Necessary for callables
     change_form_template = "lidia/change_form_lidiaterm.html"
 
     @admin.display(description="URLs")
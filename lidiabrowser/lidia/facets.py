@@ -0,0 +1,191 @@
+"""Filters of the annotation list that show the number of annotations per
+value.
+
+The counts of all annotations are stored in FacetCount by populate, so the
+unfiltered list does not have to scan the term groups. When the list is
+filtered or searched, the counts are computed for the annotations in the
+list and cached until the data changes, and values without annotations are
+hidden.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple, Type
+
+from django.contrib import admin
+from django.db.models import Count, Exists, OuterRef, Q, QuerySet
+from django.utils.translation import gettext as _
+
+from sync.pagination import get_cached
+
+from .models import Annotation, FacetCount, TermGroup
+
+# Label and number of annotations per filter value
+Counts = Dict[str, Tuple[str, int]]
+
+
+class FacetListFilter(admin.SimpleListFilter, ABC):
+    """Filter on a facet of which the counts are stored in FacetCount. The
+    parameter name is the name of the facet."""
+    # Field of the related model of which the value is shown
+    label_field: str
+
+    def lookups(self, request, model_admin):
+        self.counts = {
+            value: (label, count)
+            for value, label, count in FacetCount.objects.filter(
+                facet=self.parameter_name
+            ).order_by("label").values_list("value", "label", "count")
+        }
+        return [(value, label) for value, (label, _count) in self.counts.items()]
+
+    def choices(self, changelist):
+        if changelist.has_active_filters or changelist.query:
+            # Count the annotations in the list instead of all annotations
+            counts = get_cached(
+                changelist.queryset,
+                f"facet:{self.parameter_name}",
+                lambda: self.get_counts(changelist.queryset),
+            )
+        else:
+            counts = self.counts
+        yield {
+            "selected": self.value() is None,
+            "query_string": changelist.get_query_string(remove=[self.parameter_name]),
+            "display": _("All"),
+        }
+        for value, (label, _count) in self.counts.items():
+            count = counts.get(value, (label, 0))[1]
+            if not count and self.value() != value:
+                continue
+            yield {
+                "selected": self.value() == value,
+                "query_string": changelist.get_query_string(
+                    {self.parameter_name: value}
+                ),
+                "display": f"{label} ({count})",
+            }
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(self.get_condition(self.value()))
+
+    @abstractmethod
+    def get_condition(self, value: str) -> Q:
+        """Returns the condition for annotations with the value."""
+
+    @classmethod
+    @abstractmethod
+    def get_counts(cls, queryset: QuerySet) -> Counts:
+        """Returns the label and the number of annotations in the queryset
+        for every value."""
+
+
+class AnnotationFacetListFilter(FacetListFilter):
+    """Filter on a foreign key of the annotations."""
+    field: str
+
+    def get_condition(self, value: str) -> Q:
+        return Q(**{self.field: value})
+
+    @classmethod
+    def get_counts(cls, queryset: QuerySet) -> Counts:
+        rows = queryset.filter(**{f"{cls.field}__isnull": False}).order_by() \
+            .values_list(cls.field, f"{cls.field}__{cls.label_field}") \
+            .annotate(count=Count("pk"))
+        return {str(value): (label or value, count) for value, label, count in rows}
+
+
+class TermGroupFacetListFilter(FacetListFilter):
+    """Filter on a foreign key of the term groups of the annotations."""
+    field: str
+
+    def get_condition(self, value: str) -> Q:
+        return Q(Exists(TermGroup.objects.filter(
+            annotation=OuterRef("pk"), **{self.field: value}
+        )))
+
+    @classmethod
+    def get_counts(cls, queryset: QuerySet) -> Counts:
+        rows = TermGroup.objects.filter(
+            annotation__in=queryset.order_by().values("pk"),
+            **{f"{cls.field}__isnull": False},
+        ).order_by().values_list(
+            cls.field, f"{cls.field}__{cls.label_field}"
+        ).annotate(count=Count("annotation", distinct=True))
+        return {str(value): (label, count) for value, label, count in rows}
+
+
+class PublicationFilter(AnnotationFacetListFilter):
+    title = "publication"
+    parameter_name = "publication"
+    field = "parent_attachment"
+    label_field = "title"
+
+
+class LanguageFilter(AnnotationFacetListFilter):
+    title = "subject language"
+    parameter_name = "language"
+    field = "arglang"
+    label_field = "name"
+
+
+class ArticleTermFilter(TermGroupFacetListFilter):
+    title = "article term"
+    parameter_name = "articleterm"
+    field = "articleterm"
+    label_field = "term"
+
+
+class LidiaTermFilter(TermGroupFacetListFilter):
+    title = "LIDIA term"
+    parameter_name = "lidiaterm"
+    field = "lidiaterm"
+    label_field = "term"
+
+
+class CategoryFilter(TermGroupFacetListFilter):
+    title = "category"
+    parameter_name = "category"
+    field = "category"
+    label_field = "category"
+
+
+FACET_FILTERS: List[Type[FacetListFilter]] = [
+    PublicationFilter,
+    LanguageFilter,
+    ArticleTermFilter,
+    LidiaTermFilter,
+    CategoryFilter,
+]
+
+
+def update_facet_counts() -> int:
+    """Recomputes the counts of all facets with one grouped query per facet
+    and stores those that changed. Returns the number of changed counts."""
+    stored = {
+        (facet, value): (pk, label, count)
+        for pk, facet, value, label, count in FacetCount.objects.values_list(
+            "pk", "facet", "value", "label", "count"
+        )
+    }
+    current = {
+        (facet_filter.parameter_name, value): (label[:255], count)
+        for facet_filter in FACET_FILTERS
+        for value, (label, count)
+        in facet_filter.get_counts(Annotation.objects.all()).items()
+    }
+    changed = [
+        FacetCount(facet=facet, value=value, label=label, count=count)
+        for (facet, value), (label, count) in current.items()
+        if stored.get((facet, value), (None,))[1:] != (label, count)
+    ]
+    FacetCount.objects.bulk_create(
+        changed,
+        update_conflicts=True,
+        unique_fields=["facet", "value"],
+        update_fields=["label", "count"],
+    )
+    removed = [pk for key, (pk, *_rest) in stored.items() if key not in current]
+    FacetCount.objects.filter(pk__in=removed).delete()
+    return len(changed) + len(removed)
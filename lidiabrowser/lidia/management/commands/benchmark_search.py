@@ -0,0 +1,170 @@
+import random
+import statistics
+import string
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from django.contrib import admin
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandParser
+from django.db.models import Exists, OuterRef, QuerySet
+
+import lidia.search as search
+from lidia.models import (
+    Annotation,
+    ArticleTerm,
+    BaseAnnotation,
+    Category,
+    LidiaTerm,
+    Publication,
+    TermGroup,
+)
+from sync.populate import BATCH_SIZE, update_display_fields, upsert_child_rows
+from sync.shadow import use_database
+
+# Number of annotations per publication in the corpus
+ANNOTATIONS_PER_PUBLICATION = 100
+# Number of results that are fetched, like a changelist page
+PAGE_SIZE = 100
+
+
+def make_corpus(n_annotations: int, seed: int = 0) -> List[str]:
+    """Fills the database with random annotations with two term groups each.
+    Returns the vocabulary of the texts."""
+    rng = random.Random(seed)
+    vocabulary = sorted({
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+        for _ in range(5000)
+    })
+
+    def text(n_words: int) -> str:
+        return " ".join(rng.choices(vocabulary, k=n_words))
+
+    n_publications = -(-n_annotations // ANNOTATIONS_PER_PUBLICATION)
+    Publication.objects.bulk_create([
+        Publication(attachment_id=f"PDF{i}", title=text(5))
+        for i in range(n_publications)
+    ])
+    articleterms = ArticleTerm.objects.bulk_create([
+        ArticleTerm(term=term) for term in vocabulary[:2000]
+    ])
+    lidiaterms = LidiaTerm.objects.bulk_create([
+        LidiaTerm(term=term, vocab="lidia") for term in vocabulary[2000:2500]
+    ])
+    categories = Category.objects.bulk_create([
+        Category(category=category) for category in vocabulary[2500:2520]
+    ])
+    for start in range(0, n_annotations, BATCH_SIZE):
+        indices = range(start, min(start + BATCH_SIZE, n_annotations))
+        bases = BaseAnnotation.objects.bulk_create([
+            BaseAnnotation(
+                lidia_id=f"A{i}",
+                parent_attachment_id=f"PDF{i // ANNOTATIONS_PER_PUBLICATION}",
+                sort_index=f"{i % ANNOTATIONS_PER_PUBLICATION:05}|000001|00001",
+                textselection=text(30),
+            )
+            for i in indices
+        ])
+        upsert_child_rows(Annotation, [
+            Annotation(pk=base.pk, argname=text(3), description=text(20))
+            for base in bases
+        ])
+        TermGroup.objects.bulk_create([
+            TermGroup(
+                annotation_id=base.pk,
+                index=index,
+                termtype="definiendum",
+                articleterm=rng.choice(articleterms),
+                lidiaterm=rng.choice(lidiaterms),
+                category=rng.choice(categories),
+            )
+            for base in bases
+            for index in range(2)
+        ])
+    update_display_fields()
+    search.update_index()
+    return vocabulary
+
+
+def measure(run: Callable[[], int], repeat: int) -> Tuple[float, int]:
+    """Returns the median number of milliseconds of run and its result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), result
+
+
+class Command(BaseCommand):
+    help = "Compare the full-text search of annotations with the regular " \
+        "admin search on a synthetic corpus in a temporary database"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--annotations",
+            type=int,
+            default=100_000,
+            help="Number of annotations in the corpus (default: 100000)"
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times each search is run (default: 5)"
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory, \
+                use_database(Path(directory) / "benchmark.sqlite3"):
+            call_command("migrate", verbosity=0, interactive=False)
+            start = time.perf_counter()
+            vocabulary = make_corpus(options["annotations"])
+            self.stdout.write(
+                f"Created {options['annotations']} annotations in "
+                f"{time.perf_counter() - start:.1f} seconds."
+            )
+            self.run_searches(vocabulary, options["repeat"])
+
+    def run_searches(self, vocabulary: List[str], repeat: int) -> None:
+        model_admin = admin.site._registry[Annotation]
+        queryset = Annotation.objects.all()
+        ordering = ["parent_attachment", "sort_index", "-pk"]
+
+        def run_regular(term: str) -> int:
+            # As the changelist does it
+            qs, may_have_duplicates = admin.ModelAdmin.get_search_results(
+                model_admin, None, queryset, term
+            )
+            if may_have_duplicates:
+                qs = queryset.filter(Exists(qs.filter(pk=OuterRef("pk"))))
+            return self.fetch(qs.order_by(*ordering))
+
+        def run_fts(term: str) -> int:
+            qs = search.search(queryset, term)
+            return self.fetch(qs.order_by("search_rank", *ordering))
+
+        rng = random.Random(1)
+        terms = rng.sample(vocabulary, 3)
+        terms += [word[:3] for word in rng.sample(vocabulary, 2)]
+        terms.append(" ".join(rng.sample(vocabulary, 2)))
+        self.stdout.write(
+            f"{'search term':<24}{'regular ms':>12}{'matches':>9}"
+            f"{'full-text ms':>14}{'matches':>9}"
+        )
+        for term in terms:
+            regular_ms, regular_count = measure(lambda: run_regular(term), repeat)
+            fts_ms, fts_count = measure(lambda: run_fts(term), repeat)
+            self.stdout.write(
+                f"{term:<24}{regular_ms:>12.1f}{regular_count:>9}"
+                f"{fts_ms:>14.1f}{fts_count:>9}"
+            )
+
+    @staticmethod
+    def fetch(queryset: QuerySet) -> int:
+        """Fetches the count and first page of results. Returns the count."""
+        count = queryset.count()
+        list(queryset[:PAGE_SIZE])
+        return count
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:11
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_relations(apps, schema_editor):
+    """Fill the LIDIA IDs of existing relations and remove placeholder
+    annotations that were left behind."""
+    Annotation = apps.get_model("lidia", "Annotation")
+    BaseAnnotation = apps.get_model("lidia", "BaseAnnotation")
+    Annotation.objects.filter(relation_to__isnull=False).update(
+        relation_to_lidia_id=Subquery(
+            BaseAnnotation.objects.filter(pk=OuterRef("relation_to"))
+            .values("lidia_id")
+        )
+    )
+    BaseAnnotation.objects.filter(
+        annotation__isnull=False, zotero_annotation__isnull=True
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0004_lidiaterm_urls'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='relation_to_lidia_id',
+            field=models.CharField(blank=True, db_index=True, help_text='If the related annotation does not exist, the relation is dangling', max_length=100, null=True, verbose_name='LIDIA ID of related annotation'),
+        ),
+        migrations.RunPython(copy_relations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0005_relation_to_lidia_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LexiconEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.CharField(max_length=100, unique=True)),
+                ('urls', models.JSONField(default=list, verbose_name='URLs')),
+            ],
+            options={
+                'verbose_name_plural': 'lexicon entries',
+            },
+        ),
+    ]
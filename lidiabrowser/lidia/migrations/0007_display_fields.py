@@ -0,0 +1,40 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:22
+
+from django.db import migrations, models
+
+
+def mark_dirty(apps, schema_editor):
+    """Make the next populate compute the new fields of all annotations."""
+    apps.get_model("sync", "Annotation").objects.update(dirty=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0006_lexiconentry'),
+        ('sync', '0006_lidia_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='pdf_page_end',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='end page in PDF'),
+        ),
+        migrations.AddField(
+            model_name='annotation',
+            name='pdf_page_start',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='start page in PDF'),
+        ),
+        migrations.AddField(
+            model_name='annotation',
+            name='quotation',
+            field=models.TextField(blank=True, default='', help_text='Text selection including continuation annotations'),
+        ),
+        migrations.AddField(
+            model_name='annotation',
+            name='terms',
+            field=models.TextField(blank=True, db_index=True, default='', help_text='Summary of the term groups'),
+        ),
+        migrations.RunPython(mark_dirty, migrations.RunPython.noop),
+    ]
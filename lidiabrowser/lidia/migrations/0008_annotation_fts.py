@@ -0,0 +1,57 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+import lidia.models
+
+
+def create_index(apps, schema_editor):
+    """Create the full-text index of annotations on SQLite. It is filled by
+    the next populate."""
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE lidia_annotation_fts USING fts5("
+        "argname, description, quotation, terms, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    # Matches in the argument name and terms weigh more than matches in the
+    # longer description and quotation
+    schema_editor.execute(
+        "INSERT INTO lidia_annotation_fts (lidia_annotation_fts, rank) "
+        "VALUES ('rank', 'bm25(10.0, 2.0, 1.0, 5.0)')"
+    )
+    apps.get_model("sync", "Annotation").objects.update(dirty=True)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS lidia_annotation_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0007_display_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationSearchEntry',
+            fields=[
+                ('annotation', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='lidia.annotation')),
+                ('argname', models.TextField()),
+                ('description', models.TextField()),
+                ('quotation', models.TextField()),
+                ('terms', models.TextField()),
+                ('match', lidia.models.FullTextField(db_column='lidia_annotation_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'lidia_annotation_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_index, drop_index),
+    ]
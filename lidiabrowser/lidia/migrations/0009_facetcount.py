@@ -0,0 +1,26 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0008_annotation_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('publication', 'publication'), ('language', 'subject language'), ('articleterm', 'article term'), ('lidiaterm', 'LIDIA term'), ('category', 'category')], max_length=11)),
+                ('value', models.CharField(help_text='Value of the filter parameter', max_length=100)),
+                ('label', models.CharField(max_length=255)),
+                ('count', models.IntegerField()),
+            ],
+            options={
+                'unique_together': {('facet', 'value')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lidia', '0009_facetcount'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='baseannotation',
+            index=models.Index(fields=['parent_attachment', 'sort_index', 'id'], name='baseannotation_order_idx'),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from django.db import models
 from django.contrib import admin
 
@@ -7,6 +7,37 @@ import iso639
 import sync.models as syncmodels
 
 
+def get_language_name(code: str) -> Optional[str]:
+    """Returns the name of the language with the given ISO 639 code, or None
+    if the code is invalid."""
+    try:
+        return iso639.Lang(code).name
+    except (
+        iso639.exceptions.DeprecatedLanguageValue,
+        iso639.exceptions.InvalidLanguageValue
+    ):
+        return None
+
+
+def get_page_number(sort_index: str) -> Optional[int]:
+    """Returns the page number in the PDF of an annotation with the given
+    sort index, or None if the sort index is empty or invalid."""
+    # The page number is the first part before |, and starts with zero
+    if sort_index:
+        try:
+            return int(sort_index.split("|")[0]) + 1
+        except ValueError:
+            return None
+
+
+def get_page_range(begin: Optional[int], end: Optional[int]) -> Optional[str]:
+    if begin is None:
+        return None
+    if end is not None and end != begin:
+        return f"{begin}–{end}"
+    return str(begin)
+
+
 class Publication(models.Model):
     zotero_publication = models.OneToOneField(syncmodels.Publication, verbose_name="Zotero publication", on_delete=models.CASCADE, to_field="zotero_id", null=True)
     attachment_id = models.CharField(max_length=16, unique=True, null=True)
@@ -25,13 +56,7 @@ class Language(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.name:
-            try:
-                self.name = iso639.Lang(self.code).name
-            except (
-                iso639.exceptions.DeprecatedLanguageValue,
-                iso639.exceptions.InvalidLanguageValue
-            ):
-                pass
+            self.name = get_language_name(self.code)
         return super().save(*args, **kwargs)
 
 
@@ -43,15 +68,16 @@ class BaseAnnotation(models.Model):
     textselection = models.TextField(default='')
     sort_index = models.CharField(max_length=100, help_text="Index to keep order of annotation in document", default="")
 
+    class Meta:
+        # Order of the annotation list, used for keyset pagination
+        indexes = [models.Index(
+            fields=["parent_attachment", "sort_index", "id"],
+            name="baseannotation_order_idx",
+        )]
+
     @property
     def page_number_in_pdf(self) -> Optional[int]:
-        # Extract page number from sort index, which is the first part before
-        # |, and which starts with zero
-        if self.sort_index:
-            try:
-                return int(self.sort_index.split("|")[0]) + 1
-            except ValueError:
-                return None
+        return get_page_number(self.sort_index)
 
 
 class Annotation(BaseAnnotation):
@@ -71,6 +97,12 @@ class Annotation(BaseAnnotation):
     page_end = models.CharField(verbose_name="end page", max_length=16, null=True)
     relation_type = models.CharField(max_length=11, choices=RELATION_TYPE_CHOICES, default='')
     relation_to = models.ForeignKey('self', on_delete=models.SET_NULL, null=True)
+    relation_to_lidia_id = models.CharField(verbose_name="LIDIA ID of related annotation", max_length=100, null=True, blank=True, db_index=True, help_text="If the related annotation does not exist, the relation is dangling")
+    # Display values that are computed by populate
+    pdf_page_start = models.IntegerField(verbose_name="start page in PDF", null=True, blank=True, db_index=True)
+    pdf_page_end = models.IntegerField(verbose_name="end page in PDF", null=True, blank=True, db_index=True)
+    quotation = models.TextField(default='', blank=True, help_text="Text selection including continuation annotations")
+    terms = models.TextField(default='', blank=True, db_index=True, help_text="Summary of the term groups")
 
     # Type definitions for related managers
     termgroups: models.Manager["TermGroup"]
@@ -84,22 +116,30 @@ class Annotation(BaseAnnotation):
     def page_range(self):
         return f"{self.page_start}–{self.page_end}"
 
+    def get_continuation_annotations(self) -> List["ContinuationAnnotation"]:
+        """Returns the continuation annotations ordered by sort index. Uses
+        the prefetched continuation annotations if available. Ignores
+        continuation annotations if the model was not saved."""
+        if not self.pk:
+            return []
+        if "continuation_annotations" in getattr(
+            self, "_prefetched_objects_cache", {}
+        ):
+            return sorted(
+                self.continuation_annotations.all(),
+                key=lambda x: x.sort_index,
+            )
+        return list(self.continuation_annotations.order_by("sort_index"))
+
     @property
     @admin.display(description="Page range in PDF")
     def page_range_in_pdf(self) -> Optional[str]:
-        if self.page_number_in_pdf is None:
-            return None
-        begin = end = str(self.page_number_in_pdf)
-        # Get continuation annotation with the highest sort index, which will
-        # be the one with the highest page number. Ignore continuation
-        # annotation if the model was not saved.
-        if self.pk and (last_cont := \
-                self.continuation_annotations.order_by("-sort_index").first()):
-            end = last_cont.page_number_in_pdf
-        if end != begin:
-            return f"{begin}–{end}"
-        else:
-            return begin
+        end = None
+        # The continuation annotation with the highest sort index will be the
+        # one with the highest page number
+        if cont := self.get_continuation_annotations():
+            end = cont[-1].page_number_in_pdf
+        return get_page_range(self.page_number_in_pdf, end)
 
 
     @property
@@ -110,9 +150,10 @@ class Annotation(BaseAnnotation):
     @property
     @admin.display(description="Quotation")
     def full_quotation(self):
-        cont = self.continuation_annotations.order_by("sort_index")
         quotation = self.textselection
-        quotation += ''.join(["\n" + x.textselection for x in cont])
+        quotation += ''.join([
+            "\n" + x.textselection for x in self.get_continuation_annotations()
+        ])
         return quotation
 
     @property
@@ -120,12 +161,44 @@ class Annotation(BaseAnnotation):
     def all_zotero_ids(self) -> str:
         ids = [self.zotero_annotation_id]
         ids.extend([
-            x.zotero_annotation_id for x
-            in self.continuation_annotations.order_by("sort_index")
+            x.zotero_annotation_id for x in self.get_continuation_annotations()
         ])
         return ", ".join(ids)
 
 
+class Match(models.Lookup):
+    """Full-text query on an SQLite FTS5 table."""
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
+
+
+class FullTextField(models.TextField):
+    """Hidden column of an FTS5 table that has the name of the table."""
+
+
+FullTextField.register_lookup(Match)
+
+
+class AnnotationSearchEntry(models.Model):
+    """Row of the full-text index of annotations, which only exists on
+    SQLite. The index is maintained by lidia.search."""
+    annotation = models.OneToOneField(Annotation, models.DO_NOTHING, primary_key=True, db_column="rowid", db_constraint=False, related_name="search_entry")
+    argname = models.TextField()
+    description = models.TextField()
+    quotation = models.TextField()
+    terms = models.TextField()
+    match = FullTextField(db_column="lidia_annotation_fts")
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = "lidia_annotation_fts"
+
+
 class ContinuationAnnotation(BaseAnnotation):
     start_annotation = models.ForeignKey(Annotation, on_delete=models.SET_NULL, null=True, related_name="continuation_annotations")
 
@@ -160,6 +233,19 @@ class LidiaTerm(models.Model):
         return f"{self.term} ({self.get_vocab_display()})"
 
 
+class LexiconEntry(models.Model):
+    """Entry of the LIDIA lexicon, with the corresponding terms in other
+    vocabularies and their URLs."""
+    slug = models.CharField(max_length=100, unique=True)
+    urls = models.JSONField("URLs", default=list)
+
+    class Meta:
+        verbose_name_plural = "lexicon entries"
+
+    def __str__(self):
+        return self.slug
+
+
 class Category(models.Model):
     category = models.CharField(max_length=100, unique=True)
 
@@ -192,13 +278,25 @@ class TermGroup(models.Model):
         return f"{self.articleterm}/{lidiaterm}"
 
 
-def delete_all() -> None:
-    """Delete all objects in lidia app."""
+class FacetCount(models.Model):
+    """Number of annotations with a value of a facet, which is shown in the
+    filters of the annotation list. Computed by populate."""
+    FACET_CHOICES = [
+        ("publication", "publication"),
+        ("language", "subject language"),
+        ("articleterm", "article term"),
+        ("lidiaterm", "LIDIA term"),
+        ("category", "category"),
+    ]
+
+    facet = models.CharField(max_length=11, choices=FACET_CHOICES)
+    value = models.CharField(max_length=100, help_text="Value of the filter parameter")
+    label = models.CharField(max_length=255)
+    count = models.IntegerField()
+
+    class Meta:
+        unique_together = [['facet', 'value']]
+
+    def __str__(self):
+        return f"{self.get_facet_display()}: {self.label} ({self.count})"
 
-    Publication.objects.all().delete()
-    Language.objects.all().delete()
-    BaseAnnotation.objects.all().delete()
-    ArticleTerm.objects.all().delete()
-    LidiaTerm.objects.all().delete()
-    Category.objects.all().delete()
-    TermGroup.objects.all().delete()
@@ -0,0 +1,122 @@
+"""Full-text search of annotations with SQLite FTS5.
+
+The FTS5 table has a row for every annotation, with the annotation's
+primary key as rowid. It covers the argument name, the description, the
+quotation including continuation annotations and the article terms, LIDIA
+terms and categories of the term groups. The table is created by a
+migration on SQLite only and updated by populate; on other databases
+the admin falls back to its regular search.
+"""
+
+import re
+from typing import Iterable, Optional
+
+from django.db import connection, models, transaction
+from django.db.models import F, Value
+
+from .models import (
+    Annotation,
+    AnnotationSearchEntry,
+    ArticleTerm,
+    BaseAnnotation,
+    Category,
+    LidiaTerm,
+    TermGroup,
+)
+
+TABLE = AnnotationSearchEntry._meta.db_table
+
+# Maximum number of attachments per query
+ATTACHMENTS_PER_QUERY = 500
+
+
+def is_available() -> bool:
+    return connection.vendor == "sqlite"
+
+
+def get_match_query(search_term: str) -> str:
+    """Returns an FTS5 query that matches rows containing all words of the
+    search term, each as a prefix of a word."""
+    words = re.findall(r"\w+", search_term)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def get_index_sql(condition: str) -> str:
+    """Returns the statement that indexes the annotations that match the
+    SQL condition on the annotation (a) and base annotation (b) tables."""
+    annotation = Annotation._meta.db_table
+    base = BaseAnnotation._meta.db_table
+    termgroup = TermGroup._meta.db_table
+    articleterm = ArticleTerm._meta.db_table
+    lidiaterm = LidiaTerm._meta.db_table
+    category = Category._meta.db_table
+    return f"""
+        INSERT INTO {TABLE} (rowid, argname, description, quotation, terms)
+        SELECT a.baseannotation_ptr_id, a.argname, a.description, a.quotation, (
+            SELECT group_concat(
+                coalesce(art.term, '') || ' ' || coalesce(lt.term, '') || ' '
+                || coalesce(c.category, ''), ' '
+            )
+            FROM {termgroup} tg
+            LEFT JOIN {articleterm} art ON art.id = tg.articleterm_id
+            LEFT JOIN {lidiaterm} lt ON lt.id = tg.lidiaterm_id
+            LEFT JOIN {category} c ON c.id = tg.category_id
+            WHERE tg.annotation_id = a.baseannotation_ptr_id
+        )
+        FROM {annotation} a
+        JOIN {base} b ON b.id = a.baseannotation_ptr_id
+        WHERE {condition}
+    """
+
+
+def delete_stale_entries() -> None:
+    """Removes the rows of annotations that no longer exist."""
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {TABLE} WHERE rowid NOT IN "
+            f"(SELECT baseannotation_ptr_id FROM {Annotation._meta.db_table})"
+        )
+
+
+def update_index(attachment_ids: Optional[Iterable[str]] = None) -> None:
+    """Indexes the annotations in the given attachments, or all annotations
+    if attachment_ids is None, and removes the rows of annotations that no
+    longer exist. Should be called after the quotations are updated."""
+    if not is_available():
+        return
+    if attachment_ids is None:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+            cursor.execute(get_index_sql("1"))
+        return
+    delete_stale_entries()
+    base = BaseAnnotation._meta.db_table
+    with connection.cursor() as cursor:
+        attachment_ids = [a for a in attachment_ids if a is not None]
+        for start in range(0, len(attachment_ids), ATTACHMENTS_PER_QUERY):
+            chunk = attachment_ids[start:start + ATTACHMENTS_PER_QUERY]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            with transaction.atomic():
+                cursor.execute(
+                    f"DELETE FROM {TABLE} WHERE rowid IN (SELECT id FROM {base} "
+                    f"WHERE parent_attachment_id IN ({placeholders}))",
+                    chunk,
+                )
+                cursor.execute(
+                    get_index_sql(f"b.parent_attachment_id IN ({placeholders})"),
+                    chunk,
+                )
+
+
+def search(queryset: models.QuerySet, search_term: str) -> models.QuerySet:
+    """Filters a queryset of annotations to those that match the search
+    term and annotates them with search_rank, which is lower for better
+    matches. If the term has no words, no annotations are filtered out."""
+    match = get_match_query(search_term)
+    if not match:
+        return queryset.annotate(search_rank=Value(0.0))
+    return queryset.filter(search_entry__match=match).annotate(
+        search_rank=F("search_entry__rank")
+    )
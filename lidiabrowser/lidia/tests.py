@@ -1,8 +1,21 @@
+import io
+import re
+
 import pytest
+from django.contrib import admin
 from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from lidiabrowser.init import initiate_groups
 import lidia.models as models
+import lidia.search as search
+from lidia.facets import update_facet_counts
+from sync.models import bump_generation
+from sync.pagination import KeysetPaginator
 
 
 @pytest.mark.django_db
@@ -74,3 +87,207 @@ class TestAnnotation:
         cont.save()
         assert annot.page_range_in_pdf == "25–27"
 
+
+    def test_prefetched_continuation_annotations(self, django_assert_num_queries):
+        annot = models.Annotation.objects.create(
+            sort_index="00024|000002|00069", textselection="one"
+        )
+        for sort_index, text in [
+            ("00026|000004|00099", "three"),
+            ("00025|000004|00099", "two"),
+        ]:
+            models.ContinuationAnnotation.objects.create(
+                start_annotation=annot, sort_index=sort_index,
+                textselection=text,
+            )
+        annot = models.Annotation.objects.prefetch_related(
+            "continuation_annotations"
+        ).get()
+        with django_assert_num_queries(0):
+            assert annot.page_range_in_pdf == "25–27"
+            assert annot.full_quotation == "one\ntwo\nthree"
+
+
+@pytest.mark.django_db
+class TestAnnotationAdmin:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+
+    def fill(self, n: int):
+        publication, _ = models.Publication.objects.get_or_create(
+            attachment_id="PDF1", title="Publication"
+        )
+        language, _ = models.Language.objects.get_or_create(code="nld")
+        start = models.Annotation.objects.count()
+        for i in range(start, start + n):
+            annot = models.Annotation.objects.create(
+                lidia_id=f"A{i}", parent_attachment=publication,
+                sort_index=f"{i:05}|000001|00001", argname=f"argument {i}",
+                arglang=language, relation_type="supports",
+                relation_to=models.Annotation.objects.first(),
+            )
+            models.ContinuationAnnotation.objects.create(
+                lidia_id=f"C{i}", parent_attachment=publication,
+                start_annotation=annot, sort_index=f"{i:05}|000002|00001",
+            )
+            models.TermGroup.objects.create(
+                annotation=annot, index=0, termtype="definiendum",
+                articleterm=models.ArticleTerm.objects.get_or_create(
+                    term=f"term {i}"
+                )[0],
+                lidiaterm=models.LidiaTerm.objects.get_or_create(
+                    term="word", vocab="lidia"
+                )[0],
+                category=models.Category.objects.get_or_create(
+                    category="lexicon"
+                )[0],
+            )
+        # As populate does
+        bump_generation()
+
+    def test_changelist_num_queries(self, admin_client):
+        url = reverse("admin:lidia_annotation_changelist")
+        self.fill(2)
+        with CaptureQueriesContext(connection) as few:
+            assert admin_client.get(url).status_code == 200
+        self.fill(40)
+        with CaptureQueriesContext(connection) as many:
+            response = admin_client.get(url)
+        assert response.status_code == 200
+        assert "argument 41" in response.content.decode()
+        assert len(many) == len(few)
+
+    def test_cached_count(self, admin_client):
+        url = reverse("admin:lidia_annotation_changelist")
+        self.fill(3)
+        update_facet_counts()
+        term = models.ArticleTerm.objects.get(term="term 1")
+        for params in [{}, {"articleterm": term.pk}]:
+            with CaptureQueriesContext(connection) as first:
+                admin_client.get(url, params)
+            assert any("COUNT" in q["sql"] for q in first)
+            with CaptureQueriesContext(connection) as second:
+                response = admin_client.get(url, params)
+            assert not any("COUNT" in q["sql"] for q in second)
+        assert response.context["cl"].result_count == 1
+        assert response.context["cl"].full_result_count == 3
+
+        self.fill(1)
+        response = admin_client.get(url)
+        assert response.context["cl"].result_count == 4
+
+    def test_keyset_pagination(self, admin_client, monkeypatch):
+        url = reverse("admin:lidia_annotation_changelist")
+        self.fill(12)
+        models.Annotation.objects.create(lidia_id="NOPUB", sort_index="00000")
+        models.Annotation.objects.create(
+            lidia_id="PDF0", sort_index="00000",
+            parent_attachment=models.Publication.objects.create(
+                attachment_id="PDF0"
+            ),
+        )
+        model_admin = admin.site._registry[models.Annotation]
+        monkeypatch.setattr(model_admin, "list_per_page", 5)
+
+        def get_pages():
+            return [
+                [obj.lidia_id for obj in admin_client.get(
+                    url, {"p": page}
+                ).context["cl"].result_list]
+                for page in [1, 2, 3]
+            ]
+
+        expected = get_pages()
+        assert expected[0][:2] == ["NOPUB", "PDF0"]
+        assert sum(expected, []) == ["NOPUB", "PDF0"] + [f"A{i}" for i in range(12)]
+        monkeypatch.setattr(KeysetPaginator, "keyset_threshold", 5)
+        cache.clear()
+        # Jump to a page first, then page through
+        response = admin_client.get(url, {"p": 3})
+        assert [obj.lidia_id for obj in response.context["cl"].result_list] \
+            == expected[2]
+        with CaptureQueriesContext(connection) as queries:
+            assert get_pages() == expected
+        assert not any("OFFSET" in q["sql"] for q in queries)
+
+    def test_search(self, admin_client):
+        self.fill(3)
+        models.Annotation.objects.filter(lidia_id="A1").update(
+            description="Argument about argument structure"
+        )
+        models.Annotation.objects.filter(lidia_id="A2").update(
+            description="Argument structure"
+        )
+        search.update_index()
+        url = reverse("admin:lidia_annotation_changelist")
+        response = admin_client.get(url, {"q": "struct"})
+        assert [obj.lidia_id for obj in response.context["cl"].result_list] \
+            == ["A2", "A1"]
+        response = admin_client.get(url, {"q": "term 0"})
+        assert [obj.lidia_id for obj in response.context["cl"].result_list] \
+            == ["A0"]
+
+
+    def get_choices(self, response, parameter_name):
+        spec = next(
+            spec for spec in response.context["cl"].filter_specs
+            if spec.parameter_name == parameter_name
+        )
+        return [
+            choice["display"] for choice in spec.choices(response.context["cl"])
+        ][1:]
+
+    @pytest.mark.parametrize("model, term, expected", [
+        (models.ArticleTerm, "term 1", {"A1"}),
+        (models.LidiaTerm, "word", {"A0", "A1", "A2"}),
+    ])
+    def test_related_annotations_link(self, admin_client, model, term, expected):
+        self.fill(3)
+        update_facet_counts()
+        obj = model.objects.get(term=term)
+        page = admin_client.get(reverse(
+            f"admin:lidia_{model._meta.model_name}_change", args=[obj.pk]
+        )).content.decode()
+        url = re.search(r'href="([^"]*)"[^>]*>Show related annotations', page)[1]
+        response = admin_client.get(url)
+        assert response.status_code == 200
+        assert {a.lidia_id for a in response.context["cl"].result_list} == expected
+
+    def test_facets(self, admin_client):
+        self.fill(3)
+        models.TermGroup.objects.filter(annotation__lidia_id="A2").update(
+            articleterm=models.ArticleTerm.objects.get(term="term 1")
+        )
+        assert update_facet_counts() == 6
+        assert update_facet_counts() == 0
+        url = reverse("admin:lidia_annotation_changelist")
+        with CaptureQueriesContext(connection) as queries:
+            response = admin_client.get(url)
+        assert not any("lidia_termgroup" in q["sql"] for q in queries)
+        assert self.get_choices(response, "articleterm") == \
+            ["term 0 (1)", "term 1 (2)"]
+        assert self.get_choices(response, "language") == ["Dutch (3)"]
+
+        term = models.ArticleTerm.objects.get(term="term 1")
+        response = admin_client.get(url, {"articleterm": term.pk})
+        assert len(response.context["cl"].result_list) == 2
+        assert self.get_choices(response, "articleterm") == ["term 1 (2)"]
+        assert self.get_choices(response, "language") == ["Dutch (2)"]
+        search.update_index()
+        response = admin_client.get(url, {"q": "argument 0"})
+        assert self.get_choices(response, "articleterm") == ["term 0 (1)"]
+
+        models.Annotation.objects.filter(lidia_id="A0").delete()
+        assert update_facet_counts() == 5
+        assert not models.FacetCount.objects.filter(label="term 0").exists()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestBenchmarkSearch:
+    def test_run(self):
+        out = io.StringIO()
+        call_command("benchmark_search", annotations=50, repeat=1, stdout=out)
+        assert "Created 50 annotations" in out.getvalue()
+        # The corpus is created in a temporary database
+        assert not models.Annotation.objects.exists()
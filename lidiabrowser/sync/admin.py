@@ -1,17 +1,18 @@
 from django.contrib import admin
 
 from .models import Annotation, Publication, Sync
+from .pagination import CachedCountModelAdmin
 
 
-class AnnotationAdmin(admin.ModelAdmin):
+class AnnotationAdmin(CachedCountModelAdmin):
     pass
 
 
-class PublicationAdmin(admin.ModelAdmin):
+class PublicationAdmin(CachedCountModelAdmin):
     pass
 
 
-class SyncAdmin(admin.ModelAdmin):
+class SyncAdmin(CachedCountModelAdmin):
     pass
 
 
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def enable_wal(sender, connection, **kwargs):
+    """Switches SQLite databases to write-ahead logging, so that readers are
+    not blocked by a write transaction and keep seeing the data from before
+    it until it commits, e.g. while a shadow database is swapped in."""
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
 
 
 class SyncConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "sync"
+
+    def ready(self):
+        connection_created.connect(enable_wal)
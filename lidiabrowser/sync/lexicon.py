@@ -0,0 +1,146 @@
+"""Download and parsing of the LIDIA lexicon spreadsheet.
+
+The spreadsheet is only downloaded again if it changed on the server,
+according to the ETag and Last-Modified headers of the previous download.
+Since parsing the workbook is slow, the table of slugs and URLs parsed from
+it is stored in a JSON sidecar file next to it, together with the SHA-256
+hash of the workbook. As long as the workbook does not change, the table is
+read from the sidecar instead.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import urllib.error
+import urllib.request
+from typing import Dict, List
+
+import openpyxl
+
+logger = logging.getLogger(__name__)
+
+Lexicon = Dict[str, List[dict]]
+
+# Vocabularies of which the terms and URLs are listed in the lexicon
+VOCABS = ["ull", "ccr"]
+
+
+def get_sidecar_path(path: str) -> str:
+    return f"{path}.json"
+
+
+def read_sidecar(path: str) -> dict:
+    """Returns the contents of the sidecar of the workbook at the given path,
+    or an empty dict if there is no valid sidecar."""
+    try:
+        with open(get_sidecar_path(path)) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return sidecar if isinstance(sidecar, dict) else {}
+
+
+def write_sidecar(path: str, sidecar: dict) -> None:
+    write_atomic(
+        get_sidecar_path(path),
+        json.dumps(sidecar, separators=(",", ":")).encode(),
+    )
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Writes a file by replacing it, so that readers never see a partially
+    written file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def get_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fetch_lexicon(url: str, path: str) -> bool:
+    """Downloads the lexicon spreadsheet to the given path, unless the copy
+    that was downloaded before is still up to date. Returns True if a new
+    version was downloaded. Errors are logged, leaving an existing copy in
+    place."""
+    sidecar = read_sidecar(path)
+    request = urllib.request.Request(url)
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        if sidecar.get("etag"):
+            request.add_header("If-None-Match", sidecar["etag"])
+        if sidecar.get("last_modified"):
+            request.add_header("If-Modified-Since", sidecar["last_modified"])
+    try:
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.info("Lexicon spreadsheet is up to date.")
+        else:
+            logger.error(f"Error downloading lexicon spreadsheet: {e}")
+        return False
+    except (OSError, ValueError) as e:
+        logger.error(f"Error downloading lexicon spreadsheet: {e}")
+        return False
+    write_atomic(path, data)
+    # The parsed table, if any, is kept; it is tied to the hash of the
+    # workbook and thus still used if the contents did not change
+    sidecar["etag"] = headers.get("ETag")
+    sidecar["last_modified"] = headers.get("Last-Modified")
+    write_sidecar(path, sidecar)
+    logger.info("Lexicon spreadsheet downloaded successfully.")
+    return True
+
+
+def parse_workbook(path: str) -> Lexicon:
+    """Reads the table of slugs and the terms and URLs in the vocabularies
+    of the 'entries' sheet of the lexicon workbook, streaming the rows."""
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook['entries'].iter_rows(values_only=True)
+        headers = {value: i for i, value in enumerate(next(rows, ()))}
+        lexicon = {}
+        for row in rows:
+            slug = row[headers['slug']]
+            if slug is None:
+                continue
+            # Store terms and urls if they exist
+            lexicon[slug] = [
+                {
+                    'vocab': vocab,
+                    'term': row[headers[vocab]],
+                    'url': row[headers[f"{vocab}-url"]],
+                }
+                for vocab in VOCABS
+                if row[headers[vocab]]
+            ]
+    finally:
+        workbook.close()
+    return lexicon
+
+
+def load_lexicon(path: str) -> Lexicon:
+    """Returns the table of slugs and their URLs of the lexicon workbook at
+    the given path, from the sidecar if it belongs to the same workbook.
+    Returns an empty table if there is no workbook."""
+    if not os.path.isfile(path):
+        logger.error(f"Lexicon spreadsheet {path} does not exist.")
+        return {}
+    sha256 = get_sha256(path)
+    sidecar = read_sidecar(path)
+    if sidecar.get("sha256") == sha256 and "entries" in sidecar:
+        return sidecar["entries"]
+    lexicon = parse_workbook(path)
+    sidecar.update({"sha256": sha256, "entries": lexicon})
+    write_sidecar(path, sidecar)
+    return lexicon
@@ -1,7 +1,8 @@
-from django.core.management.base import BaseCommand, CommandParser
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
-from sync.populate import populate
-from lidia.models import delete_all
+from sync.populate import BATCH_SIZE, populate
+from sync.shadow import ShadowError, build_shadow
 
 
 class Command(BaseCommand):
@@ -11,10 +12,46 @@ class Command(BaseCommand):
         parser.add_argument(
             "--refresh",
             action="store_true",
-            help="First remove annotations from database to solve any sync problems"
+            help="Rebuild the LIDIA objects from all sync data instead of only "
+            "the data that changed since the last populate, to solve any sync "
+            "problems"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of items that are processed and committed together "
+            f"(default: {BATCH_SIZE})"
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes that parse LIDIA annotations (default: 1)"
+        )
+
+        parser.add_argument(
+            "--shadow",
+            nargs="?",
+            const="",
+            metavar="PATH",
+            help="Rebuild all LIDIA objects in a copy of the database at PATH "
+            "(default: the database file with .shadow appended) and swap "
+            "them in when done, so that the site keeps serving the previous "
+            "data in the meantime"
         )
 
     def handle(self, *args, **options):
-        if options["refresh"]:
-            delete_all()
-        populate()
+        kwargs = {
+            "batch_size": options["batch_size"],
+            "workers": options["workers"],
+        }
+        if options["shadow"] is None:
+            populate(refresh=options["refresh"], **kwargs)
+            return
+        path = options["shadow"] or \
+            f"{settings.DATABASES['default']['NAME']}.shadow"
+        try:
+            build_shadow(path, **kwargs)
+        except ShadowError as e:
+            raise CommandError(str(e))
@@ -13,8 +13,24 @@ class Command(BaseCommand):
             action="store_true",
             help="First remove sync information from database to solve any sync problems"
         )
+        parser.add_argument(
+            "--by-version",
+            action="store_true",
+            help="Fetch the versions of changed items first and only download "
+            "items whose version differs from the local copy"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Maximum number of concurrent requests to the Zotero API "
+            "(default: ZOTERO_SYNC_CONCURRENCY setting); 1 fetches all pages "
+            "one after another"
+        )
 
     def handle(self, *args, **options):
         if options["refresh"]:
             delete_all()
-        sync()
+        sync(
+            by_version=options["by_version"],
+            concurrency=options["concurrency"],
+        )
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.25 on 2026-10-17 18:50
+
+from django.db import migrations, models
+
+
+def copy_versions(apps, schema_editor):
+    """Fill the new version column from the stored item content."""
+    for model_name in ["Publication", "Annotation"]:
+        model = apps.get_model("sync", model_name)
+        batch = []
+        for obj in model.objects.only("pk", "content").iterator():
+            obj.version = obj.content.get("version", 0)
+            batch.append(obj)
+            if len(batch) == 500:
+                model.objects.bulk_update(batch, ["version"])
+                batch = []
+        model.objects.bulk_update(batch, ["version"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='version',
+            field=models.IntegerField(db_index=True, default=0, help_text='Zotero item version'),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='version',
+            field=models.IntegerField(db_index=True, default=0, help_text='Zotero item version'),
+        ),
+        migrations.RunPython(copy_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.25 on 2026-10-17 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0002_item_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('library_id', models.CharField(max_length=100)),
+                ('stream', models.CharField(max_length=20)),
+                ('since_version', models.IntegerField(help_text='Local library version when the sync started')),
+                ('target_version', models.IntegerField(help_text='Library version the sync is heading for')),
+                ('start', models.IntegerField(default=0, help_text='Offset of the first page that has not been saved')),
+                ('completed', models.BooleanField(default=False)),
+            ],
+            options={
+                'unique_together': {('library_id', 'stream')},
+            },
+        ),
+    ]
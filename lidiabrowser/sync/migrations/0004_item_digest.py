@@ -0,0 +1,43 @@
+# Generated by Django 4.2.25 on 2026-10-17 18:59
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+def compute_digests(apps, schema_editor):
+    """Fill the new digest column from the stored item content, in the same
+    way as sync.zoterosync.get_digest."""
+    for model_name in ["Publication", "Annotation"]:
+        model = apps.get_model("sync", model_name)
+        batch = []
+        for obj in model.objects.only("pk", "content").iterator():
+            data = json.dumps(obj.content, sort_keys=True, separators=(",", ":"))
+            obj.digest = hashlib.sha256(data.encode()).hexdigest()
+            batch.append(obj)
+            if len(batch) == 500:
+                model.objects.bulk_update(batch, ["digest"])
+                batch = []
+        model.objects.bulk_update(batch, ["digest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0003_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the item JSON', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the item JSON', max_length=64),
+        ),
+        migrations.RunPython(compute_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0004_item_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='dirty',
+            field=models.BooleanField(db_index=True, default=True, help_text='Changed since the last populate'),
+        ),
+        migrations.AddField(
+            model_name='publication',
+            name='dirty',
+            field=models.BooleanField(db_index=True, default=True, help_text='Changed since the last populate'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.25 on 2026-10-17 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync', '0005_dirty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='is_lidia',
+            field=models.BooleanField(db_index=True, help_text='Whether this is a LIDIA annotation; unknown if not extracted yet', null=True),
+        ),
+        migrations.AddField(
+            model_name='annotation',
+            name='lidia_data',
+            field=models.JSONField(blank=True, help_text='Parsed LIDIA data', null=True),
+        ),
+        migrations.AddField(
+            model_name='annotation',
+            name='lidia_error',
+            field=models.TextField(blank=True, default='', help_text='Error in the LIDIA data'),
+        ),
+    ]
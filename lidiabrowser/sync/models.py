@@ -6,6 +6,9 @@ from contextlib import suppress
 class Publication(models.Model):
     zotero_id = models.CharField(max_length=100, unique=True)
     content = models.JSONField(default=dict)
+    version = models.IntegerField(default=0, db_index=True, help_text="Zotero item version")
+    digest = models.CharField(max_length=64, blank=True, db_index=True, help_text="SHA-256 of the item JSON")
+    dirty = models.BooleanField(default=True, db_index=True, help_text="Changed since the last populate")
 
     def __str__(self):
         return self.zotero_id
@@ -21,6 +24,13 @@ class Publication(models.Model):
 class Annotation(models.Model):
     zotero_id = models.CharField(max_length=100, unique=True)
     content = models.JSONField(default=dict)
+    version = models.IntegerField(default=0, db_index=True, help_text="Zotero item version")
+    digest = models.CharField(max_length=64, blank=True, db_index=True, help_text="SHA-256 of the item JSON")
+    dirty = models.BooleanField(default=True, db_index=True, help_text="Changed since the last populate")
+    # LIDIA data extracted from the comment when the annotation is synced
+    is_lidia = models.BooleanField(null=True, db_index=True, help_text="Whether this is a LIDIA annotation; unknown if not extracted yet")
+    lidia_data = models.JSONField(null=True, blank=True, help_text="Parsed LIDIA data")
+    lidia_error = models.TextField(blank=True, default="", help_text="Error in the LIDIA data")
 
     def __str__(self):
         return self.zotero_id
@@ -34,8 +44,45 @@ class Sync(models.Model):
         return f"Library #{self.library_id}"
 
 
+class Checkpoint(models.Model):
+    """Progress of a sync of one item stream (publications or annotations),
+    so that an interrupted sync can be continued."""
+    library_id = models.CharField(max_length=100)
+    stream = models.CharField(max_length=20)
+    since_version = models.IntegerField(help_text="Local library version when the sync started")
+    target_version = models.IntegerField(help_text="Library version the sync is heading for")
+    start = models.IntegerField(default=0, help_text="Offset of the first page that has not been saved")
+    completed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = [["library_id", "stream"]]
+
+    def __str__(self):
+        return f"Library #{self.library_id} {self.stream} from {self.start}"
+
+
+class Generation(models.Model):
+    """Counter that is increased whenever a sync, populate or admin user
+    changes the data, so that cached counts can be invalidated. There is
+    only one row."""
+    value = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Generation {self.value}"
+
+
+def get_generation() -> int:
+    return Generation.objects.values_list("value", flat=True).first() or 0
+
+
+def bump_generation() -> None:
+    if not Generation.objects.update(value=models.F("value") + 1):
+        Generation.objects.get_or_create(pk=1, defaults={"value": 1})
+
+
 def delete_all() -> None:
     """Delete all objects in sync app."""
     Publication.objects.all().delete()
     Annotation.objects.all().delete()
     Sync.objects.all().delete()
+    Checkpoint.objects.all().delete()
@@ -0,0 +1,208 @@
+"""Pagination of large admin changelists.
+
+Counting the objects of a filtered changelist and skipping to a deep page
+with OFFSET both take longer as the database grows. CachedCountPaginator
+caches the number of objects per query until the data changes, which is
+tracked with the generation counter in sync.models. KeysetPaginator in
+addition fetches the pages of large result sets that are ordered by a
+known key by seeking to the first key of the page instead of using OFFSET.
+"""
+
+import hashlib
+from typing import Any, Callable, Optional, Sequence, Tuple, TypeVar
+
+from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+
+from sync.models import bump_generation, get_generation
+
+# Seconds that counts and page keys are cached; they are invalidated earlier
+# when the data changes
+CACHE_TIMEOUT = 24 * 60 * 60
+
+T = TypeVar("T")
+
+
+def get_cache_key(queryset: QuerySet, kind: str) -> Optional[str]:
+    """Returns a cache key for data about the queryset in the current
+    generation, or None if the queryset cannot match any objects."""
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    digest = hashlib.sha256(
+        f"{queryset.db}\n{sql}\n{params!r}".encode()
+    ).hexdigest()
+    return f"{kind}:{get_generation()}:{digest}"
+
+
+def get_cached(queryset: QuerySet, kind: str, compute: Callable[[], T]) -> T:
+    """Returns the result of compute, which computes data of the given kind
+    about the queryset, from the cache if it was computed before in the
+    current generation."""
+    key = get_cache_key(queryset, kind)
+    if key is None:
+        return compute()
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
+
+
+def get_cached_count(queryset: QuerySet) -> int:
+    # The ordering does not change the count, so the paginator of an
+    # unfiltered list and the full result count share the cached count
+    queryset = queryset.order_by()
+    return get_cached(queryset, "count", queryset.count)
+
+
+class CachedCountPaginator(Paginator):
+    """Paginator that caches the number of objects until the data changes."""
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            return get_cached_count(self.object_list)
+        return super().count
+
+
+def get_keyset_condition(
+    fields: Sequence[str], values: Sequence[Any], nulls_largest: bool
+) -> Q:
+    """Returns the condition for rows of which the values of the fields are
+    the given values or come after them in ascending order."""
+    field, *other_fields = fields
+    value, *other_values = values
+    if value is None:
+        after = Q(pk__in=[]) if nulls_largest else Q(**{f"{field}__isnull": False})
+        equal = Q(**{f"{field}__isnull": True})
+        bound = Q() if not nulls_largest else equal
+    else:
+        after = Q(**{f"{field}__gt": value})
+        equal = Q(**{field: value})
+        bound = Q(**{f"{field}__gte": value})
+        if nulls_largest:
+            after |= Q(**{f"{field}__isnull": True})
+            bound |= Q(**{f"{field}__isnull": True})
+    if not other_fields:
+        return bound
+    # The redundant bound on the first field lets the database seek in an
+    # index instead of evaluating the condition for every row
+    return bound & (after | (equal & get_keyset_condition(
+        other_fields, other_values, nulls_largest
+    )))
+
+
+class KeysetPaginator(CachedCountPaginator):
+    """Paginator that fetches pages without OFFSET if there are more than
+    keyset_threshold objects and they are ordered by the keyset fields in
+    ascending order. The first key of a page is taken from the previous
+    page if it was fetched before, and otherwise looked up with a query
+    that only reads the keys."""
+    # Fields of the ordering; the last one must be unique
+    keyset: Tuple[str, ...] = ()
+    keyset_threshold = 10000
+
+    def uses_keyset(self) -> bool:
+        if not self.keyset or not isinstance(self.object_list, QuerySet):
+            return False
+        # The admin may add fields that are already in the ordering
+        ordering = tuple(dict.fromkeys(self.object_list.query.order_by))
+        return ordering == self.keyset and self.count > self.keyset_threshold
+
+    def get_key(self, obj) -> tuple:
+        opts = self.object_list.model._meta
+        return tuple(
+            obj.pk if name == "pk" else getattr(obj, opts.get_field(name).attname)
+            for name in self.keyset
+        )
+
+    def get_page_key_cache_key(self, number: int) -> Optional[str]:
+        key = get_cache_key(self.object_list, "page")
+        return key and f"{key}:{self.per_page}:{number}"
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.uses_keyset():
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if top + self.orphans >= self.count:
+            top = self.count
+        objects = self.object_list
+        if number > 1:
+            cache_key = self.get_page_key_cache_key(number)
+            start = cache.get(cache_key)
+            if start is None:
+                start = self.object_list.values_list(*self.keyset)[bottom]
+                cache.set(cache_key, start, CACHE_TIMEOUT)
+            objects = objects.filter(get_keyset_condition(
+                self.keyset, start,
+                connections[objects.db].features.nulls_order_largest,
+            ))
+        # Fetch the first object of the next page as well to know its key
+        objects = list(objects[:top - bottom + 1])
+        if len(objects) > top - bottom:
+            cache.set(
+                self.get_page_key_cache_key(number + 1),
+                self.get_key(objects.pop()),
+                CACHE_TIMEOUT,
+            )
+        return self._get_page(objects, number, self)
+
+
+class CachedCountChangeList(ChangeList):
+    """ChangeList that shows the cached number of all objects instead of
+    counting them for every page."""
+
+    def get_results(self, request):
+        super().get_results(request)
+        # The model admin disables show_full_result_count, so that the
+        # default implementation does not count
+        self.show_full_result_count = True
+        self.full_result_count = get_cached_count(self.root_queryset)
+        self.show_admin_actions = bool(self.full_result_count)
+
+
+class CachedCountAdminMixin:
+    """Mixin for model admins of large tables that caches the number of
+    objects and fetches deep pages without OFFSET if keyset is set to the
+    ordering of the list."""
+    paginator = KeysetPaginator
+    show_full_result_count = False
+    keyset: Tuple[str, ...] = ()
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        paginator = super().get_paginator(
+            request, queryset, per_page, orphans, allow_empty_first_page
+        )
+        paginator.keyset = self.keyset
+        return paginator
+
+    def get_changelist(self, request, **kwargs):
+        return CachedCountChangeList
+
+    # Changes made in the admin invalidate the cached counts as well
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        bump_generation()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_generation()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        bump_generation()
+
+
+class CachedCountModelAdmin(CachedCountAdminMixin, admin.ModelAdmin):
+    pass
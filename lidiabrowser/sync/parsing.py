@@ -0,0 +1,71 @@
+"""Parsing of the LIDIA data that is stored as YAML in the comments of Zotero
+annotations.
+
+This module does not depend on Django, so that it can be used in worker
+processes.
+"""
+
+import json
+from typing import Any, List, Optional, Tuple
+
+import yaml
+
+LIDIAPREFIX = "~~~~LIDIA~~~~"
+
+# The libyaml-based loader is much faster, but is only available if PyYAML
+# was built with libyaml
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def is_lidia_comment(comment: str) -> bool:
+    return comment.startswith(LIDIAPREFIX)
+
+
+def load_lidia_comment(comment: str) -> Any:
+    """Returns the data in the YAML after the LIDIA prefix of a comment.
+    Raises yaml.YAMLError if the YAML is invalid."""
+    return yaml.load(comment.removeprefix(LIDIAPREFIX), Loader=SafeLoader)
+
+
+def get_data_error(key: str, data: Any) -> str:
+    """Returns an error message if the LIDIA data does not have the expected
+    structure, and otherwise an empty string."""
+    if not isinstance(data, dict):
+        return f"Invalid LIDIA data in annotation with key {key}"
+    termgroups = data.get("termgroups")
+    if termgroups and not (
+        isinstance(termgroups, list)
+        and all(isinstance(termgroup, dict) for termgroup in termgroups)
+    ):
+        return f"Invalid term groups in annotation with key {key}"
+    return ""
+
+
+def extract_lidia_data(key: str, comment: str) -> Tuple[bool, Optional[dict], str]:
+    """Extracts the LIDIA data from the comment of the annotation with the
+    given key. Returns whether it is a LIDIA annotation, the data if it is
+    valid, and otherwise an error message.
+    The data is converted to plain JSON, e.g. dates become strings."""
+    if not is_lidia_comment(comment):
+        return False, None, ""
+    try:
+        data = load_lidia_comment(comment)
+    except yaml.YAMLError as e:
+        return True, None, f"YAMLError: {e}"
+    error = get_data_error(key, data)
+    if error:
+        return True, None, error
+    return True, json.loads(json.dumps(data, default=str)), ""
+
+
+def extract_comments(
+    comments: List[Tuple[str, str]]
+) -> List[Tuple[bool, Optional[dict], str]]:
+    """Extracts the LIDIA data of a list of (key, comment) pairs."""
+    return [extract_lidia_data(key, comment) for key, comment in comments]
+
+
+def extract_item(item: dict) -> Tuple[bool, Optional[dict], str]:
+    """Extracts the LIDIA data of a Zotero annotation item."""
+    data = item.get("data", {})
+    return extract_lidia_data(item["key"], data.get("annotationComment") or "")
@@ -1,14 +1,22 @@
 import logging
-import os
-import shutil
-import urllib.request
-import yaml
+import time
 
-import openpyxl
 from django.conf import settings
-from django.db import transaction
-from typing import Optional
+from collections import Counter, defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+from functools import partial, reduce
+from itertools import chain
+from operator import or_
+from typing import (
+    Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional,
+    Sequence, Set, Tuple, Type,
+)
 
+import lidia.search as search
+from lidia.facets import update_facet_counts
 import sync.models as syncmodels
 from lidia.models import (
     Annotation,
@@ -17,252 +25,845 @@ from lidia.models import (
     Category,
     ContinuationAnnotation,
     Language,
+    LexiconEntry,
     LidiaTerm,
     Publication,
     TermGroup,
+    get_language_name,
+    get_page_number,
 )
+from sync.lexicon import Lexicon, fetch_lexicon, load_lexicon
+from sync.parsing import extract_comments, get_data_error
 from sync.zoteroutils import get_attachment_url, get_attachment_id_from_url
 
 
 logger = logging.getLogger(__name__)
 
 
-LIDIAPREFIX = "~~~~LIDIA~~~~"
-LEXICON_URLS = {}
+# Default number of sync objects that are processed and committed together
+BATCH_SIZE = 2000
+# Fields of annotations that are computed by update_display_fields()
+DISPLAY_FIELDS = ["pdf_page_start", "pdf_page_end", "quotation", "terms"]
+# Number of annotations that is sent to a worker process at once for parsing
+PARSE_CHUNK_SIZE = 100
 
 
 def fetch_lexicon_data():
-    url = settings.LEXICON_URL
-    filename = settings.LEXICON_FILEPATH
+    fetch_lexicon(settings.LEXICON_URL, str(settings.LEXICON_FILEPATH))
+
+
+def load_lexicon_data() -> Lexicon:
+    return load_lexicon(str(settings.LEXICON_FILEPATH))
 
-    if os.path.isfile(filename) and os.path.getsize(filename) > 0:
-        logger.info("Lexicon spreadsheet already downloaded.")
+
+def update_lexicon(lexicon: Lexicon) -> None:
+    """Stores the lexicon in the LexiconEntry table and updates the URLs of
+    the LIDIA terms of the entries that were added, changed or removed, in a
+    single query."""
+    if not lexicon:
+        # Rather keep the stored lexicon than removing all URLs
+        logger.warning("Lexicon is empty; keeping the stored lexicon.")
+        return
+    stored = dict(LexiconEntry.objects.values_list("slug", "urls"))
+    changed = [slug for slug, urls in lexicon.items() if stored.get(slug) != urls]
+    removed = stored.keys() - lexicon.keys()
+    if not changed and not removed:
         return
+    LexiconEntry.objects.bulk_create(
+        [LexiconEntry(slug=slug, urls=lexicon[slug]) for slug in changed],
+        update_conflicts=True,
+        unique_fields=["slug"],
+        update_fields=["urls"],
+    )
+    LexiconEntry.objects.filter(slug__in=removed).delete()
+    n_updated = LidiaTerm.objects.filter(
+        vocab='lidia', term__in=[*changed, *removed]
+    ).update(urls=Subquery(
+        LexiconEntry.objects.filter(slug=OuterRef("term")).values("urls")[:1]
+    ))
+    logger.info(
+        f"Updated {len(changed)} and removed {len(removed)} lexicon entries; "
+        f"updated the URLs of {n_updated} LIDIA terms."
+    )
+
+
+def process_continuation_annotations(
+    attachment_ids: Optional[Iterable[str]] = None
+) -> None:
+    """Links continuation annotations to the annotation preceding them in
+    their attachment. If attachment_ids is given, only the annotations in
+    those attachments are processed.
 
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-    try:
-        with urllib.request.urlopen(url) as response, \
-        open(filename, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
-        logger.info("Lexicon spreadsheet downloaded successfully.")
-    except Exception as e:
-        logger.error(f"Error downloading lexicon spreadsheet: {e}")
-
-
-def load_lexicon_data():
-    workbook = openpyxl.load_workbook(settings.LEXICON_FILEPATH)
-    sheet = workbook['entries']
-    headers = {}
-    for i, cell in enumerate(sheet[1]):  # Get headers from the first row
-        headers[cell.value] = i
-    for row in sheet.iter_rows(min_row=2, values_only=True):  # Skip header
-        slug = row[headers['slug']]
-        # Store terms and urls if they exist
-        LEXICON_URLS[slug] = []
-        if row[headers['ull']]:
-            LEXICON_URLS[slug].append({'vocab': 'ull', 'term': row[headers['ull']], 'url': row[headers['ull-url']]})
-        if row[headers['ccr']]:
-            LEXICON_URLS[slug].append({'vocab': 'ccr', 'term': row[headers['ccr']], 'url': row[headers['ccr-url']]})
-
-
-def process_continuation_annotations() -> None:
-    # Get all annotations in order of presence in documents
+    The annotations are scanned once in order of presence in documents,
+    reading only the columns that are needed; only the continuation
+    annotations of which the link changes are updated."""
     annotations = BaseAnnotation.objects.order_by(
         "parent_attachment", "sort_index"
     )
+    if attachment_ids is not None:
+        annotations = annotations.filter(parent_attachment__in=attachment_ids)
+    rows = annotations.values_list(
+        "pk",
+        "lidia_id",
+        "parent_attachment",
+        # Primary keys of the subclass rows; None if it is not of that class
+        "annotation",
+        "continuationannotation",
+        "continuationannotation__start_annotation",
+    )
     current_parent = None
     current_first_annotation = None
-    to_be_deleted = []
-    for annotation in annotations:
-        if hasattr(annotation, "annotation"):
-            # Object is of Annotation model (first annotation)
-            current_first_annotation = annotation.annotation  # type: ignore
-            current_parent = annotation.parent_attachment
-        elif hasattr(annotation, "continuationannotation"):
-            # Object is of ContinuationAnnotation model
-            if annotation.parent_attachment != current_parent:
+    to_be_linked = []
+    for (pk, lidia_id, parent, annotation_pk, continuation_pk,
+            start_annotation_pk) in rows.iterator():
+        if annotation_pk is not None:
+            # First annotation
+            current_first_annotation = annotation_pk
+            current_parent = parent
+        elif continuation_pk is not None:
+            if parent is None or parent != current_parent:
                 # This continuation annotation is the first annotation in
                 # the current attachment. This should not be the case, so
-                # delete it and give a warning.
+                # give a warning. It is kept without start annotation, so
+                # that it is linked once an annotation before it is synced.
                 logger.warning(
-                    f"Annotation {annotation} in {annotation.parent_attachment} "
-                    "is a continuation annotation but there is no annotation "
-                    "before it. This annotation will be absent from the database."
+                    f"Annotation {lidia_id} in {parent} is a continuation "
+                    "annotation but there is no annotation before it. This "
+                    "annotation will not be shown."
                 )
-                to_be_deleted.append(annotation)
-                continue
-            ca = annotation.continuationannotation  # type: ignore
-            assert isinstance(ca, ContinuationAnnotation)
-            ca.start_annotation = current_first_annotation
-            ca.save()
-    
-    for annotation in to_be_deleted:
-        annotation.delete()
-
-
-def create_lidiaterm(lexiconterm: str, customterm: str) -> Optional[LidiaTerm]:
-    urls_data = None
+                if start_annotation_pk is not None:
+                    to_be_linked.append(ContinuationAnnotation(
+                        pk=pk, start_annotation_id=None
+                    ))
+            elif start_annotation_pk != current_first_annotation:
+                to_be_linked.append(ContinuationAnnotation(
+                    pk=pk, start_annotation_id=current_first_annotation
+                ))
+
+    ContinuationAnnotation.objects.bulk_update(
+        to_be_linked, ["start_annotation"], batch_size=BATCH_SIZE
+    )
+
+
+def update_rows(
+    model: Type[models.Model], objs: List[models.Model], fields: Sequence[str]
+) -> None:
+    """Updates the given fields of the objects with one UPDATE statement per
+    object, which the database executes as a single prepared statement."""
+    if not objs:
+        return
+    opts = model._meta
+    qn = connection.ops.quote_name
+    model_fields = [opts.get_field(name) for name in fields]
+    assignments = ", ".join(f"{qn(field.column)} = %s" for field in model_fields)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(
+            f"UPDATE {qn(opts.db_table)} SET {assignments} "
+            f"WHERE {qn(opts.pk.column)} = %s",
+            [
+                [
+                    field.get_db_prep_save(getattr(obj, field.attname), connection)
+                    for field in model_fields
+                ] + [obj.pk]
+                for obj in objs
+            ],
+        )
+
+
+def update_display_fields(
+    attachment_ids: Optional[Iterable[str]] = None
+) -> int:
+    """Computes the page range in the PDF, the quotation and the summary of
+    the term groups of annotations, which depend on their continuation
+    annotations and term groups, and stores the values that changed. If
+    attachment_ids is given, only the annotations in those attachments are
+    processed. Returns the number of updated annotations."""
+    annotations = Annotation.objects.all()
+    if attachment_ids is not None:
+        annotations = annotations.filter(parent_attachment__in=attachment_ids)
+    n_updated = 0
+    for batch in iter_batches(annotations):
+        pks = [annotation.pk for annotation in batch]
+        continuations = defaultdict(list)
+        for start_pk, sort_index, textselection in ContinuationAnnotation \
+                .objects.filter(start_annotation__in=pks) \
+                .order_by("sort_index") \
+                .values_list("start_annotation", "sort_index", "textselection"):
+            continuations[start_pk].append((sort_index, textselection))
+        terms = defaultdict(list)
+        for annotation_pk, articleterm, lidiaterm in TermGroup.objects \
+                .filter(annotation__in=pks) \
+                .order_by("index") \
+                .values_list("annotation", "articleterm__term", "lidiaterm__term"):
+            # Same format as str() of a term group
+            terms[annotation_pk].append(f"{articleterm}/{lidiaterm}")
+
+        changed = []
+        for annotation in batch:
+            cont = continuations[annotation.pk]
+            values = {
+                "pdf_page_start": get_page_number(annotation.sort_index),
+                "pdf_page_end": get_page_number(
+                    cont[-1][0] if cont else annotation.sort_index
+                ),
+                "quotation": "".join(
+                    [annotation.textselection] +
+                    ["\n" + textselection for _, textselection in cont]
+                ),
+                "terms": ", ".join(terms[annotation.pk]),
+            }
+            if any(getattr(annotation, f) != v for f, v in values.items()):
+                for field, value in values.items():
+                    setattr(annotation, field, value)
+                changed.append(annotation)
+        # Much faster than bulk_update(), which builds a CASE per field
+        update_rows(Annotation, changed, DISPLAY_FIELDS)
+        n_updated += len(changed)
+    return n_updated
+
+
+def get_lidiaterm_key(data: dict) -> Optional[Tuple[str, str]]:
+    """Returns the vocabulary and term of the LIDIA term of a term group."""
+    lexiconterm = data.get("lexiconterm", "")
+    customterm = data.get("customterm", "")
     if not lexiconterm:
         return None
     if lexiconterm == 'custom':
         if not customterm:
             return None
-        vocab = 'custom'
-        term = customterm
-    else:
-        vocab = 'lidia'
-        term = lexiconterm
-        if term in LEXICON_URLS:
-            urls_data = LEXICON_URLS[term]
-    lidiaterm, _ = LidiaTerm.objects.get_or_create(
-        vocab=vocab,
-        term=term,
-        defaults={'urls': urls_data}
-    )
+        return 'custom', str(customterm)
+    return 'lidia', str(lexiconterm)
+
+
+def get_articleterm(data: dict) -> Optional[str]:
+    """Returns the article term of a term group as a string, since YAML
+    turns e.g. 1984 into a number, like the other lookup keys."""
+    articleterm = data.get("articleterm", None)
+    return str(articleterm) if articleterm else None
+
+
+def get_category(data: dict) -> Optional[str]:
+    category = data.get("category", None) or None
+    if category == 'custom':
+        category = data.get("customcategory", None)
+    return str(category) if category else None
+
+
+class LookupCache:
+    """Maps the natural key of the objects of a lookup table to their primary
+    keys, so that populate does not need a query for every reference.
+
+    The table is loaded once. Missing objects are created in bulk by
+    ensure(), after which their primary keys are queried once. The natural
+    key is the value of a single field or a tuple of values of several
+    fields.
+    """
+
+    # Maximum number of keys that is queried at once
+    chunk_size = 200
+
+    def __init__(
+        self,
+        model: Type[models.Model],
+        fields: Sequence[str],
+        defaults: Optional[Callable[..., dict]] = None,
+    ):
+        self.model = model
+        self.fields = list(fields)
+        self.defaults = defaults
+        self.pks: Dict[Hashable, int] = {}
+        self.load(model.objects.all())
+
+    def to_key(self, values: Sequence[Any]) -> Hashable:
+        return values[0] if len(self.fields) == 1 else tuple(values)
+
+    def to_values(self, key: Hashable) -> Sequence[Any]:
+        return [key] if len(self.fields) == 1 else key  # type: ignore
+
+    def load(self, queryset: models.QuerySet) -> None:
+        for *values, pk in queryset.values_list(*self.fields, "pk"):
+            self.pks[self.to_key(values)] = pk
+
+    def ensure(self, keys: Iterable[Hashable]) -> None:
+        """Creates the objects of the given keys that do not exist yet."""
+        missing = list({key for key in keys if key not in self.pks})
+        if not missing:
+            return
+        objs = []
+        for key in missing:
+            values = self.to_values(key)
+            kwargs = dict(zip(self.fields, values))
+            if self.defaults:
+                kwargs |= self.defaults(*values)
+            objs.append(self.model(**kwargs))
+        # Other objects may have been created in the meantime
+        self.model.objects.bulk_create(objs, ignore_conflicts=True)
+        for start in range(0, len(missing), self.chunk_size):
+            condition = Q()
+            for key in missing[start:start + self.chunk_size]:
+                condition |= Q(**dict(zip(self.fields, self.to_values(key))))
+            self.load(self.model.objects.filter(condition))
+
+    def get(self, key: Optional[Hashable]) -> Optional[int]:
+        """Returns the primary key of the object with the given key, which
+        is created if needed, or None if key is None."""
+        if key is None:
+            return None
+        self.ensure([key])
+        return self.pks[key]
 
-    return lidiaterm
 
+class Lookups:
+    """Caches of the lookup tables for the duration of a populate."""
 
-def create_term_group(annotation: Annotation, index: int, data: dict) -> TermGroup:
-    articleterm_str = data.get("articleterm", None) or None
-    if articleterm_str:
-        articleterm, _ = ArticleTerm.objects.get_or_create(term=articleterm_str)
-    else:
-        articleterm = None
-    category_str = data.get("category", None) or None
-    if category_str == 'custom':
-        category_str = data.get("customcategory", None)
-    if category_str:
-        category, _ = Category.objects.get_or_create(category=category_str)
-    else:
-        category = None
-    lidiaterm = create_lidiaterm(
-        data.get("lexiconterm", ""),
-        data.get("customterm", "")
-    )
-    
-    defaults = {
-        "termtype": data.get("termtype", None) or None,
-        "articleterm": articleterm,
-        "category": category,
-        "lidiaterm": lidiaterm,
-    }
-    termgroup, created = TermGroup.objects.get_or_create(
-        annotation=annotation,
+    def __init__(self):
+        self.reload()
+
+    def reload(self) -> None:
+        """Loads the tables again, e.g. because objects that were created
+        in a transaction that was rolled back are gone."""
+        self.articleterms = LookupCache(ArticleTerm, ["term"])
+        self.categories = LookupCache(Category, ["category"])
+        self.lexicon = dict(LexiconEntry.objects.values_list("slug", "urls"))
+        self.lidiaterms = LookupCache(
+            LidiaTerm, ["vocab", "term"], defaults=self.get_lidiaterm_defaults
+        )
+        self.languages = LookupCache(
+            Language, ["code"], defaults=lambda code: {"name": get_language_name(code)}
+        )
+
+    def get_lidiaterm_defaults(self, vocab: str, term: str) -> dict:
+        urls_data = None
+        if vocab == 'lidia':
+            urls_data = self.lexicon.get(term)
+        return {'urls': urls_data}
+
+    def prepare(self, termgroups: List[dict]) -> None:
+        """Creates all lookup objects referred to by the given term groups
+        that do not exist yet, with one query per table."""
+        self.articleterms.ensure(
+            key for data in termgroups if (key := get_articleterm(data))
+        )
+        self.categories.ensure(
+            key for data in termgroups if (key := get_category(data))
+        )
+        self.lidiaterms.ensure(
+            key for data in termgroups if (key := get_lidiaterm_key(data))
+        )
+
+
+def make_term_group(
+    annotation_id: int, index: int, data: dict, lookups: Lookups
+) -> TermGroup:
+    """Returns an unsaved term group; the lookup objects it refers to should
+    have been prepared."""
+    return TermGroup(
+        annotation_id=annotation_id,
         index=index,
-        defaults=defaults
+        termtype=data.get("termtype", None) or None,
+        articleterm_id=lookups.articleterms.get(get_articleterm(data)),
+        category_id=lookups.categories.get(get_category(data)),
+        lidiaterm_id=lookups.lidiaterms.get(get_lidiaterm_key(data)),
     )
-    if not created:
-        for field, value in defaults.items():
-            setattr(termgroup, field, value)
-        termgroup.save()
 
-    return termgroup
 
+def iter_batches(
+    queryset: models.QuerySet, size: int = BATCH_SIZE
+) -> Iterator[List[models.Model]]:
+    """Yields the objects of the queryset in lists of at most the given size,
+    in order of primary key. Unlike QuerySet.iterator(), this does not keep
+    a cursor open while the objects are processed."""
+    last_pk = None
+    while True:
+        batch_qs = queryset.order_by("pk")
+        if last_pk is not None:
+            batch_qs = batch_qs.filter(pk__gt=last_pk)
+        batch = list(batch_qs[:size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def mark_clean(objs: List[models.Model]) -> None:
+    """Clears the dirty flag of sync objects, unless they were changed by a
+    sync in the meantime. Since the digest covers the key of the item, the
+    digests of different items never match."""
+    if objs:
+        type(objs[0]).objects.filter(
+            pk__in=[obj.pk for obj in objs],
+            digest__in=[obj.digest for obj in objs],
+        ).update(dirty=False)
+
+
+def get_affected_attachments(attachment_ids: Set[str]) -> Set[str]:
+    """Returns the given attachments plus those containing continuation
+    annotations that are not linked to an annotation, e.g. because the
+    annotation they belonged to was deleted during a sync."""
+    unlinked = ContinuationAnnotation.objects.filter(
+        start_annotation__isnull=True, parent_attachment__isnull=False
+    ).values_list("parent_attachment", flat=True)
+    return attachment_ids | set(unlinked)
+
+
+def save_publications(
+    pubs: List[syncmodels.Publication]
+) -> Tuple[Set[str], Set[int]]:
+    """Upserts the LIDIA publications of a batch of sync publications.
+    Returns their attachments and, like save_annotations, the primary keys
+    of the sync objects that were skipped, which is always empty."""
+    publications = []
+    for pub in pubs:
+        attachment_url = get_attachment_url(pub.content)
+        attachment_id = get_attachment_id_from_url(attachment_url)
+        data = pub.content.get('data', {})
+        publications.append(Publication(
+            zotero_publication_id=pub.zotero_id,
+            attachment_id=attachment_id,
+            title=data.get('title', ''),
+        ))
+    Publication.objects.bulk_create(
+        publications,
+        update_conflicts=True,
+        unique_fields=["zotero_publication"],
+        update_fields=["attachment_id", "title"],
+    )
+    return {publication.attachment_id for publication in publications}, set()
+
+
+def extract_lidia_fields(
+    annotations: List[syncmodels.Annotation],
+    executor: Optional[Executor] = None,
+) -> None:
+    """Extracts the LIDIA data of sync annotations of which it was not
+    extracted during the sync, e.g. because they were synced before the LIDIA
+    data was stored. The comments are parsed in chunks in the given process
+    pool, if any."""
+    comments = [
+        (
+            annotation.zotero_id,
+            annotation.content.get('data', {}).get('annotationComment') or '',
+        )
+        for annotation in annotations
+    ]
+    if executor:
+        chunks = [
+            comments[start:start + PARSE_CHUNK_SIZE]
+            for start in range(0, len(comments), PARSE_CHUNK_SIZE)
+        ]
+        results = chain.from_iterable(executor.map(extract_comments, chunks))
+    else:
+        results = extract_comments(comments)
+    for annotation, (is_lidia, data, error) in zip(annotations, results):
+        annotation.is_lidia = is_lidia
+        annotation.lidia_data = data
+        annotation.lidia_error = error
+    # Do not overwrite annotations that were synced in the meantime
+    syncmodels.Annotation.objects.filter(is_lidia__isnull=True).bulk_update(
+        annotations, ["is_lidia", "lidia_data", "lidia_error"]
+    )
 
-def populate():
-    fetch_lexicon_data()
-    load_lexicon_data() # Load LEXICON_URLS global
 
-    for pub in syncmodels.Publication.objects.iterator():
-        with transaction.atomic():
-            zotero_id = pub.zotero_id
-            attachment_url = get_attachment_url(pub.content)
-            attachment_id = get_attachment_id_from_url(attachment_url)
-            data = pub.content.get('data', {})
-            defaults = {
-                'attachment_id': attachment_id,
-                'title': data.get('title', ''),
-            }
-            publication, created = Publication.objects.get_or_create(
-                zotero_publication_id=zotero_id,
-                # Only set fields if a new object is created
-                defaults=defaults
+def get_payloads(annotations: List[syncmodels.Annotation]) -> Dict[str, dict]:
+    """Returns a mapping of the Zotero keys of the given LIDIA annotations of
+    which the data is valid to their data, and logs the errors of the
+    others. The structure of the data is checked again, because data that
+    was extracted by an earlier version may not have been checked."""
+    payloads = {}
+    for annotation in annotations:
+        if not annotation.is_lidia:
+            continue
+        error = annotation.lidia_error or get_data_error(
+            annotation.zotero_id, annotation.lidia_data
+        )
+        if error:
+            logger.error(error)
+        else:
+            payloads[annotation.zotero_id] = annotation.lidia_data
+    return payloads
+
+
+def parse_annotation(annotation: syncmodels.Annotation, anno: dict) -> dict:
+    """Returns the values to be saved for a sync annotation with the given
+    LIDIA data. Identifiers are converted to strings, since YAML turns
+    e.g. 123 into a number."""
+    zotero_id = annotation.zotero_id
+    data = annotation.content.get('data', {})
+    parsed = {
+        'lidia_id': str(anno.get("lidiaId") or zotero_id),
+        'argcont': bool(anno.get('argcont')),
+        'base': {
+            'zotero_annotation_id': zotero_id,
+            'textselection': data.get('annotationText', ''),
+            # Publication should exist so use foreign key column directly
+            'parent_attachment_id': data.get('parentItem'),
+            'sort_index': data.get("annotationSortIndex"),
+        },
+    }
+    if not parsed['argcont']:
+        relation_to = anno.get('relationTo')
+        parsed['fields'] = {
+            'argname': anno.get('argname', '') or '',
+            'arglang_id': str(anno.get('arglang') or 'unspecified'),
+            'description': anno.get('description', ''),
+            'page_start': anno.get('pagestart', None) or None,
+            'page_end': anno.get('pageend', None) or None,
+            'relation_type': anno.get('relationType', '') or '',
+            'relation_to_lidia_id': str(relation_to) if relation_to else None,
+        }
+        parsed['termgroups'] = anno.get('termgroups', []) or []
+    return parsed
+
+
+def upsert_child_rows(
+    model: Type[BaseAnnotation],
+    objs: List[BaseAnnotation],
+    update_fields: Sequence[str] = (),
+) -> None:
+    """Inserts the rows of the table of a subclass of BaseAnnotation for
+    objects of which the BaseAnnotation row exists, or updates the given
+    fields if the row exists as well.
+    QuerySet.bulk_create() refuses multi-table inheritance, so this writes
+    the INSERT ... ON CONFLICT statement itself."""
+    if not objs:
+        return
+    opts = model._meta
+    fields = opts.local_concrete_fields
+    qn = connection.ops.quote_name
+    if update_fields:
+        columns = [qn(opts.get_field(name).column) for name in update_fields]
+        conflict = "DO UPDATE SET " + ", ".join(
+            f"{column} = excluded.{column}" for column in columns
+        )
+    else:
+        conflict = "DO NOTHING"
+    batch_size = connection.ops.bulk_batch_size(fields, objs)
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            row = "(" + ", ".join(["%s"] * len(fields)) + ")"
+            cursor.execute(
+                f"INSERT INTO {qn(opts.db_table)} "
+                f"({', '.join(qn(field.column) for field in fields)}) "
+                f"VALUES {', '.join([row] * len(batch))} "
+                f"ON CONFLICT ({qn(opts.pk.column)}) {conflict}",
+                [
+                    field.get_db_prep_save(getattr(obj, field.attname), connection)
+                    for obj in batch
+                    for field in fields
+                ],
             )
-            if not created:
-                publication.attachment_id = attachment_id
-                publication.title = data.get('title', '')
-                # Just save all fields without checking which fields need updating
-                publication.save()
 
-    for annotation in syncmodels.Annotation.objects.iterator():
+
+def delete_stale_annotations(parsed: Dict[str, dict]) -> None:
+    """Deletes the annotations that would conflict with the given parsed
+    annotations: those of which the LIDIA ID of their Zotero annotation
+    changed, and those that changed from annotation to continuation
+    annotation or vice versa. They are recreated by the upsert."""
+    lidia_ids = {
+        p['base']['zotero_annotation_id']: lidia_id
+        for lidia_id, p in parsed.items()
+    }
+    stale = [
+        pk for pk, zotero_id, lidia_id in BaseAnnotation.objects.filter(
+            zotero_annotation__in=lidia_ids.keys()
+        ).values_list("pk", "zotero_annotation", "lidia_id")
+        if lidia_id != lidia_ids[zotero_id]
+    ]
+    stale.extend(
+        pk for pk, lidia_id, annotation_pk in BaseAnnotation.objects.filter(
+            lidia_id__in=parsed.keys()
+        ).values_list("pk", "lidia_id", "annotation")
+        if parsed[lidia_id]['argcont'] == (annotation_pk is not None)
+    )
+    if stale:
+        BaseAnnotation.objects.filter(pk__in=stale).delete()
+
+
+def get_orphan_annotations() -> models.QuerySet:
+    """Returns the annotations of which the sync annotation is gone or no
+    longer a LIDIA annotation."""
+    return BaseAnnotation.objects.filter(
+        Q(zotero_annotation__isnull=True) |
+        ~Exists(syncmodels.Annotation.objects.filter(
+            zotero_id=OuterRef("zotero_annotation"), is_lidia=True
+        ))
+    )
+
+
+def delete_orphans() -> Dict[str, int]:
+    """Deletes the LIDIA objects of which the sync object is gone or no
+    longer a LIDIA annotation, and the terms and categories that are no
+    longer used. Languages are kept, since they can be maintained in the
+    admin. Returns the number of deleted objects per model."""
+    deleted = Counter()
+
+    def delete(queryset: models.QuerySet) -> None:
+        deleted.update(queryset.delete()[1])
+
+    delete(Publication.objects.filter(
+        Q(zotero_publication__isnull=True) |
+        ~Exists(syncmodels.Publication.objects.filter(
+            zotero_id=OuterRef("zotero_publication")
+        ))
+    ))
+    delete(get_orphan_annotations())
+    for model, field in [
+        (ArticleTerm, "articleterm"),
+        (Category, "category"),
+        (LidiaTerm, "lidiaterm"),
+    ]:
+        delete(model.objects.filter(
+            ~Exists(TermGroup.objects.filter(**{field: OuterRef("pk")}))
+        ))
+    return {label: count for label, count in deleted.items() if count}
+
+
+def resolve_relations() -> int:
+    """Points the relations of annotations to the annotations with the LIDIA
+    IDs they refer to, updating only the relations that changed. Returns the
+    number of dangling relations, of which the related annotation does not
+    exist (continuation annotations cannot be referred to)."""
+    Annotation.objects.filter(
+        relation_to_lidia_id__isnull=True, relation_to__isnull=False
+    ).update(relation_to=None)
+    Annotation.objects.filter(relation_to_lidia_id__isnull=False).filter(
+        Q(relation_to__isnull=True)
+        | ~Q(relation_to__lidia_id=F("relation_to_lidia_id"))
+    ).update(relation_to=Subquery(
+        Annotation.objects.filter(lidia_id=OuterRef("relation_to_lidia_id"))
+        .values("pk")[:1]
+    ))
+    return Annotation.objects.filter(
+        relation_to_lidia_id__isnull=False, relation_to__isnull=True
+    ).count()
+
+
+def save_annotations(
+    annotations: List[syncmodels.Annotation],
+    lookups: Lookups,
+    payloads: Optional[Dict[str, dict]] = None,
+) -> Tuple[Set[str], Set[int]]:
+    """Upserts the annotations, continuation annotations and term groups of
+    a batch of sync annotations with one batch per table. payloads are the
+    LIDIA data of the annotations that is valid; if not given, it is taken
+    from the annotations. Annotations of which the publication does not
+    exist are skipped, so that they are saved once it does. Returns the
+    attachments of the annotations and the primary keys of the skipped
+    sync annotations."""
+    if payloads is None:
+        payloads = get_payloads(annotations)
+    candidates = [
+        (annotation, parse_annotation(annotation, payloads[annotation.zotero_id]))
+        for annotation in annotations if annotation.zotero_id in payloads
+    ]
+    # Foreign keys are only checked when the transaction is committed, when
+    # a missing publication would make the whole batch fail
+    parents = {p['base']['parent_attachment_id'] for _, p in candidates}
+    existing = set(Publication.objects.filter(
+        attachment_id__in=parents - {None}
+    ).values_list("attachment_id", flat=True))
+    skipped = set()
+    # If several annotations have the same LIDIA ID, the last one wins
+    parsed = {}
+    for annotation, p in candidates:
+        parent = p['base']['parent_attachment_id']
+        if parent is not None and parent not in existing:
+            logger.warning(
+                f"Skipping annotation {annotation.zotero_id}: publication "
+                f"{parent} does not exist."
+            )
+            skipped.add(annotation.pk)
+        else:
+            parsed[p['lidia_id']] = p
+    if not parsed:
+        return set(), skipped
+    first = [p for p in parsed.values() if not p['argcont']]
+    lookups.languages.ensure(p['fields']['arglang_id'] for p in first)
+    lookups.prepare([data for p in first for data in p['termgroups']])
+
+    delete_stale_annotations(parsed)
+    BaseAnnotation.objects.bulk_create(
+        [
+            BaseAnnotation(lidia_id=lidia_id, **p['base'])
+            for lidia_id, p in parsed.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["lidia_id"],
+        update_fields=[
+            "zotero_annotation", "parent_attachment", "textselection",
+            "sort_index",
+        ],
+    )
+    pks = dict(
+        BaseAnnotation.objects.filter(lidia_id__in=parsed.keys())
+        .values_list("lidia_id", "pk")
+    )
+    upsert_child_rows(ContinuationAnnotation, [
+        ContinuationAnnotation(pk=pks[p['lidia_id']])
+        for p in parsed.values() if p['argcont']
+    ])
+    # The relations themselves are resolved once all annotations are saved
+    upsert_child_rows(Annotation, [
+        Annotation(pk=pks[p['lidia_id']], **p['fields']) for p in first
+    ], update_fields=[
+        "argname", "arglang", "description", "page_start", "page_end",
+        "relation_type", "relation_to_lidia_id",
+    ])
+    TermGroup.objects.bulk_create(
+        [
+            make_term_group(pks[p['lidia_id']], index, data, lookups)
+            for p in first
+            for index, data in enumerate(p['termgroups'])
+        ],
+        update_conflicts=True,
+        unique_fields=["annotation", "index"],
+        update_fields=["termtype", "articleterm", "category", "lidiaterm"],
+    )
+    # Term groups that were removed from the annotations
+    lengths = defaultdict(list)
+    for p in first:
+        lengths[len(p['termgroups'])].append(pks[p['lidia_id']])
+    TermGroup.objects.filter(reduce(or_, (
+        Q(annotation__in=annotation_pks, index__gte=length)
+        for length, annotation_pks in lengths.items()
+    ), Q(pk__in=[]))).delete()
+    return {
+        p['base']['parent_attachment_id'] for p in parsed.values()
+        if p['base']['parent_attachment_id']
+    }, skipped
+
+
+class CommitTimer:
+    """Keeps track of the number of transactions and the time spent
+    committing them."""
+
+    def __init__(self):
+        self.n_commits = 0
+        self.seconds = 0.0
+
+    @contextmanager
+    def atomic(self) -> Iterator[None]:
         with transaction.atomic():
-            zotero_id = annotation.zotero_id
-            data = annotation.content.get('data', {})
-            annotation_comment = data.get('annotationComment', '')
-            if not annotation_comment.startswith(LIDIAPREFIX):
-                logger.info(
-                    f"Ignoring annotation with key {zotero_id}: not a LIDIA annotation"
-                )
-                continue
-            yamlstr = annotation_comment.removeprefix(LIDIAPREFIX)
-            try:
-                anno = yaml.safe_load(yamlstr)
-            except yaml.YAMLError as e:
-                logger.error(f"YAMLError: {e}")
-                continue
-
-            lidia_id = anno.get("lidiaId") or zotero_id
-            defaults = {
-                'zotero_annotation': annotation,
-                'textselection': data.get('annotationText', ''),
-                # Publication should exist so use foreign key column directly
-                'parent_attachment_id': data.get('parentItem'),
-                'sort_index': data.get("annotationSortIndex"),
-            }
-            argcont = anno.get('argcont')
-            if argcont:
-                ContinuationAnnotation.objects.get_or_create(
-                    lidia_id=lidia_id,
-                    defaults=defaults
-                )
-            else:
-                arglang_id = anno.get('arglang', 'unspecified') or 'unspecified'
-                Language.objects.get_or_create(code=arglang_id)
-
-                relation_to_id = anno.get('relationTo') or None
-                relation_to_obj = None
-                if relation_to_id:
-                    # Create a placeholder annotation to reference
-                    relation_to_obj, _ = Annotation.objects.get_or_create(lidia_id=relation_to_id)
-
-                defaults |= {
-                    'argname': anno.get('argname', '') or '',
-                    'arglang_id': arglang_id,
-                    'description': anno.get('description', ''),
-                    'page_start': anno.get('pagestart', None) or None,
-                    'page_end': anno.get('pageend', None) or None,
-                    'relation_type': anno.get('relationType', '') or '',
-                    'relation_to': relation_to_obj,
-                }
-
-                lidia_annotation, created = Annotation.objects.get_or_create(
-                    lidia_id=lidia_id,
-                    defaults=defaults
-                )
-                if not created:
-                    for field, value in defaults.items():
-                        setattr(lidia_annotation, field, value)
-                    lidia_annotation.save()
-
-                termgroupdata = anno.get('termgroups', [])
-                if termgroupdata is None:
-                    termgroupdata = []
-                for index, data in enumerate(termgroupdata):
-                    termgroup = create_term_group(lidia_annotation, index, data)
-                    termgroup.save()
-
-    process_continuation_annotations()
-
-    remaining_placeholders = Annotation.objects.filter(
-        zotero_annotation__isnull=True
+            yield
+            start = time.monotonic()
+        self.seconds += time.monotonic() - start
+        self.n_commits += 1
+
+
+def save_batch(
+    save: Callable[[List[models.Model]], Tuple[Set[str], Set[int]]],
+    batch: List[models.Model],
+    timer: CommitTimer,
+    on_rollback: Callable[[], None],
+) -> Set[str]:
+    """Saves a batch of sync objects with the given function in a
+    transaction and marks the saved objects clean. save returns the
+    attachments of the objects and the primary keys of the objects that it
+    skipped. If saving fails because of a database error, e.g. because of
+    invalid data in one of the objects, the objects are saved one by one,
+    each in a savepoint, and the objects that cannot be saved stay dirty.
+    on_rollback is called whenever a savepoint is rolled back.
+    Returns the attachments of the saved objects."""
+    result = set()
+    saved = []
+    with timer.atomic():
+        try:
+            with transaction.atomic():
+                result, skipped = save(batch)
+            saved = [obj for obj in batch if obj.pk not in skipped]
+        except DatabaseError as e:
+            on_rollback()
+            logger.warning(f"Saving batch failed ({e}); retrying one by one.")
+            for obj in batch:
+                try:
+                    with transaction.atomic():
+                        attachments, skipped = save([obj])
+                except DatabaseError as e:
+                    on_rollback()
+                    logger.error(f"Could not save {obj}: {e}")
+                    continue
+                result |= attachments
+                if not skipped:
+                    saved.append(obj)
+        mark_clean(saved)
+    return result
+
+
+def populate(
+    refresh: bool = False, batch_size: int = BATCH_SIZE, workers: int = 1
+):
+    """Converts the sync objects that changed since the last populate to
+    LIDIA objects. If refresh is True, all sync objects are processed.
+    The objects are processed in batches of the given size, each in its own
+    transaction. Only LIDIA annotations are processed. If workers is larger
+    than 1, LIDIA data that was not extracted during the sync is extracted
+    in a pool of that many processes."""
+    fetch_lexicon_data()
+    update_lexicon(load_lexicon_data())
+
+    publications = syncmodels.Publication.objects.all()
+    annotations = syncmodels.Annotation.objects.all()
+    if not refresh:
+        publications = publications.filter(dirty=True)
+        annotations = annotations.filter(dirty=True)
+    # Attachments of which the continuation annotations have to be linked
+    attachment_ids = set()
+    lookups = Lookups()
+    timer = CommitTimer()
+
+    for batch in iter_batches(publications, batch_size):
+        attachment_ids |= save_batch(
+            save_publications, batch, timer, on_rollback=lambda: None
+        )
+
+    with ProcessPoolExecutor(workers) if workers > 1 else nullcontext() as executor:
+        for batch in iter_batches(
+            syncmodels.Annotation.objects.filter(is_lidia__isnull=True),
+            batch_size,
+        ):
+            extract_lidia_fields(batch, executor)
+
+    n_ignored = annotations.filter(is_lidia=False).update(dirty=False)
+    if n_ignored:
+        logger.info(f"Ignoring {n_ignored} annotations that are not LIDIA annotations.")
+    for batch in iter_batches(annotations.filter(is_lidia=True), batch_size):
+        attachment_ids |= save_batch(
+            partial(save_annotations, lookups=lookups),
+            batch,
+            timer,
+            # Lookup objects created in the transaction are gone
+            on_rollback=lookups.reload,
+        )
+    logger.info(
+        f"Committed {timer.n_commits} batches in {timer.seconds:.2f} seconds."
     )
-    count = remaining_placeholders.count()
+
+    # The annotations left in the attachments of deleted annotations may
+    # have to be linked to other continuation annotations
+    attachment_ids.update(
+        get_orphan_annotations().values_list("parent_attachment", flat=True)
+    )
+    deleted = delete_orphans()
+    if deleted:
+        logger.info("Deleted stale objects: " + ", ".join(
+            f"{count} {label}" for label, count in sorted(deleted.items())
+        ))
+
+    if refresh:
+        process_continuation_annotations()
+        update_display_fields()
+        search.update_index()
+    else:
+        affected = get_affected_attachments(attachment_ids)
+        process_continuation_annotations(affected)
+        update_display_fields(affected)
+        search.update_index(affected)
+    update_facet_counts()
+    syncmodels.bump_generation()
+
+    count = resolve_relations()
     if count:
         logger.warning(
-            f"There were references to {count} non-existing annotation(s)."
+            f"There are references to {count} non-existing annotation(s)."
         )
-        # TODO: include a warning in the annotations having invalid references
-        remaining_placeholders.delete()
-
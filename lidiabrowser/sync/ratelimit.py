@@ -0,0 +1,175 @@
+"""Rate limiting for requests to the Zotero API.
+
+The Zotero API asks clients to slow down with a Backoff header (on any
+response) or a Retry-After header (on 429 and 503 responses). All requests
+of a sync share a RateLimiter, which pauses every request while a backoff
+is active and adapts the number of concurrent requests: it is halved when
+the server asks to back off and grows by one again after a series of
+requests without such a signal.
+"""
+
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from pyzotero import zotero_errors
+
+logger = logging.getLogger(__name__)
+
+# Status codes of responses that are retried
+RETRY_STATUS_CODES = {429, 503}
+
+
+def get_backoff_seconds(response: httpx.Response) -> Optional[float]:
+    """Returns the number of seconds the server asks to wait according to
+    the Backoff or Retry-After header, or None if there is no such header.
+    Retry-After can be given in seconds or as an HTTP date."""
+    value = response.headers.get("Backoff") or response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class RateLimiter:
+    """Shared pacing state for all requests to the Zotero API."""
+
+    # Number of consecutive requests without backoff after which one more
+    # concurrent request is allowed
+    grow_after = 10
+
+    def __init__(self, max_concurrency: int = 1):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.concurrency = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        # Monotonic time until which no request may be started
+        self.paused_until = 0.0
+        # Wall-clock seconds during which requests were paused
+        self.throttled_time = 0.0
+        self.n_throttled = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Waits until a request may be started."""
+        with self.condition:
+            while True:
+                remainder = self.paused_until - time.monotonic()
+                if remainder <= 0 and self.in_flight < self.concurrency:
+                    self.in_flight += 1
+                    return
+                self.condition.wait(remainder if remainder > 0 else None)
+
+    def release(self) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def backoff(self, seconds: float) -> None:
+        """Pauses all requests for the given number of seconds and halves
+        the number of concurrent requests."""
+        with self.condition:
+            now = time.monotonic()
+            until = now + seconds
+            if until > self.paused_until:
+                self.throttled_time += until - max(now, self.paused_until)
+                self.paused_until = until
+            self.n_throttled += 1
+            self.successes = 0
+            concurrency = max(self.concurrency // 2, 1)
+            if concurrency < self.concurrency:
+                logger.info(
+                    f"Zotero API asks to back off for {seconds:g} seconds; "
+                    f"reducing concurrency to {concurrency}."
+                )
+            self.concurrency = concurrency
+            self.condition.notify_all()
+
+    def success(self) -> None:
+        """Registers a request that did not ask to back off."""
+        with self.condition:
+            self.successes += 1
+            if (self.successes >= self.grow_after and
+                    self.concurrency < self.max_concurrency):
+                self.concurrency += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """HTTP transport that paces requests with a RateLimiter and retries
+    requests that are rate limited or fail because of a network error."""
+
+    max_retries = 5
+    # Base delay in seconds for retries without a Retry-After header; doubled
+    # for every attempt
+    retry_delay = 1.0
+    # Maximum fraction of the delay that is added at random, so that
+    # concurrent requests do not all retry at the same moment
+    jitter = 0.5
+
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def get_retry_delay(self, attempt: int, seconds: Optional[float]) -> float:
+        if seconds is None:
+            seconds = self.retry_delay * 2 ** attempt
+        return seconds * (1 + random.uniform(0, self.jitter))
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.max_retries
+            self.limiter.acquire()
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError as e:
+                if last_attempt:
+                    raise
+                delay = self.get_retry_delay(attempt, None)
+                logger.warning(
+                    f"{e!r} for {request.url}; retrying in {delay:.1f} seconds."
+                )
+                response = None
+            finally:
+                self.limiter.release()
+            if response is None:
+                time.sleep(delay)
+                attempt += 1
+                continue
+            seconds = get_backoff_seconds(response)
+            if response.status_code in RETRY_STATUS_CODES:
+                response.close()
+                if last_attempt:
+                    raise zotero_errors.TooManyRetriesError(
+                        f"Still rate-limited after {self.max_retries} retries: "
+                        f"{request.url}"
+                    )
+                self.limiter.backoff(self.get_retry_delay(attempt, seconds))
+                attempt += 1
+            elif seconds is not None:
+                # Successful response, but the following requests should wait
+                self.limiter.backoff(seconds)
+                return response
+            else:
+                self.limiter.success()
+                return response
+
+    def close(self) -> None:
+        self.transport.close()
@@ -0,0 +1,148 @@
+"""Populate into a shadow copy of the SQLite database.
+
+A full rebuild takes a while, and running it against the live database
+would show users half-populated tables. build_shadow() instead copies the
+live database to a shadow file, populates the shadow, validates it and
+then replaces the LIDIA tables and the search index of the live database
+with those of the shadow in a single transaction. Since the database uses
+write-ahead logging (see sync.apps), readers are not blocked and keep
+seeing the previous data until that transaction commits.
+"""
+
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Union
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+import lidia.search as search
+from lidia.facets import update_facet_counts
+from sync.models import bump_generation
+from sync.populate import delete_orphans, populate
+
+logger = logging.getLogger(__name__)
+
+StrPath = Union[str, Path]
+
+
+class ShadowError(Exception):
+    """Raised when the shadow database cannot be built or swapped in."""
+
+
+def get_lidia_tables() -> List[str]:
+    """Returns the tables of the LIDIA models, except the search index,
+    which is rebuilt instead."""
+    return [
+        model._meta.db_table
+        for model in apps.get_app_config("lidia").get_models()
+        if model._meta.managed and not model._meta.proxy
+    ]
+
+
+def copy_database(path: StrPath) -> None:
+    """Copies a consistent snapshot of the live database to path."""
+    connection.ensure_connection()
+    if os.path.exists(path):
+        os.remove(path)
+    target = sqlite3.connect(path)
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
+
+
+@contextmanager
+def use_database(path: StrPath) -> Iterator[None]:
+    """Points the default database alias at a separate connection to the
+    SQLite file at path in the current thread. The connection to the live
+    database is left untouched and restored afterwards."""
+    live = connections[DEFAULT_DB_ALIAS]
+    other = type(live)({**live.settings_dict, "NAME": str(path)}, DEFAULT_DB_ALIAS)
+    connections[DEFAULT_DB_ALIAS] = other
+    try:
+        yield
+    finally:
+        other.close()
+        connections[DEFAULT_DB_ALIAS] = live
+
+
+def validate_database() -> None:
+    """Checks the integrity and foreign keys of the connected database."""
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA integrity_check")
+        result = [row[0] for row in cursor.fetchall()]
+        if result != ["ok"]:
+            raise ShadowError(f"Integrity check failed: {'; '.join(result)}")
+        cursor.execute("PRAGMA foreign_key_check")
+        violations = cursor.fetchall()
+        if violations:
+            raise ShadowError(
+                f"{len(violations)} foreign key violation(s), first in table "
+                f"{violations[0][0]}"
+            )
+
+
+def swap_in(path: StrPath) -> None:
+    """Replaces the LIDIA tables and the search index of the live database
+    with those of the database at path in one transaction.
+    Sync objects that did not change since they were copied are marked as
+    populated, and LIDIA objects of sync objects that were removed in the
+    meantime are deleted. The facet counts are updated afterwards."""
+    with connection.cursor() as cursor:
+        cursor.execute("ATTACH DATABASE %s AS shadow", [str(path)])
+        try:
+            # Foreign keys are checked once all tables have been copied
+            with connection.constraint_checks_disabled(), transaction.atomic():
+                for table in get_lidia_tables():
+                    cursor.execute(f'DELETE FROM "{table}"')
+                    cursor.execute(
+                        f'INSERT INTO "{table}" SELECT * FROM shadow."{table}"'
+                    )
+                if search.is_available():
+                    columns = "rowid, argname, description, quotation, terms"
+                    cursor.execute(f'DELETE FROM "{search.TABLE}"')
+                    cursor.execute(
+                        f'INSERT INTO "{search.TABLE}" ({columns}) '
+                        f'SELECT {columns} FROM shadow."{search.TABLE}"'
+                    )
+                for table in ["sync_publication", "sync_annotation"]:
+                    cursor.execute(
+                        f'UPDATE "{table}" SET dirty = 0 WHERE dirty AND EXISTS '
+                        f'(SELECT 1 FROM shadow."{table}" s WHERE '
+                        f's.zotero_id = "{table}".zotero_id AND '
+                        f's.digest = "{table}".digest AND NOT s.dirty)'
+                    )
+                delete_orphans()
+                connection.check_constraints(get_lidia_tables())
+                bump_generation()
+        finally:
+            cursor.execute("DETACH DATABASE shadow")
+    # Outside the swap, to keep it short
+    search.delete_stale_entries()
+    update_facet_counts()
+
+
+def build_shadow(path: StrPath, **kwargs) -> None:
+    """Rebuilds all LIDIA objects in a shadow database at path and swaps
+    them into the live database when the shadow is valid. kwargs are
+    passed to populate()."""
+    if connection.vendor != "sqlite":
+        raise ShadowError("Shadow builds require an SQLite database.")
+    if connection.in_atomic_block:
+        raise ShadowError("Shadow builds cannot run inside a transaction.")
+    logger.info(f"Copying database to {path}.")
+    copy_database(path)
+    try:
+        with use_database(path):
+            populate(refresh=True, **kwargs)
+            validate_database()
+        swap_in(path)
+        logger.info("Swapped the shadow database into the live database.")
+    finally:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(f"{path}{suffix}"):
+                os.remove(f"{path}{suffix}")
@@ -1,2 +1,1478 @@
+import hashlib
+import io
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Set, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import httpx
+import openpyxl
+import pytest
+import yaml
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from pyzotero import zotero, zotero_errors
+
+import sync.lexicon as lexicon
+import sync.parsing as parsing
+import sync.populate as populate
+import sync.shadow as shadow
+import sync.zoterosync as zoterosync
+import lidia.models as lidiamodels
+import lidia.search as search
+from sync.models import Annotation, Checkpoint, Publication, Sync, get_generation
+from sync.ratelimit import RateLimitedTransport, RateLimiter, get_backoff_seconds
+from sync.zoterosync import get_digest, save_items, save_pages
+
+
+def make_item(key: str, version: int = 1, **data) -> dict:
+    return {
+        "key": key,
+        "version": version,
+        "data": {"key": key, "version": version, **data},
+    }
+
+
+def make_publication(key: str, attachment: str, version: int = 1, **data) -> dict:
+    item = make_item(key, version, itemType="book", **data)
+    item["links"] = {
+        "attachment": {"href": f"https://api.zotero.org/groups/1/items/{attachment}"}
+    }
+    return item
+
+
+def make_annotation(
+    key: str, parent: str, sort_index: str, version: int = 1, **lidia
+) -> dict:
+    """Returns an annotation item with the given LIDIA data in its comment."""
+    return make_item(
+        key,
+        version,
+        itemType="annotation",
+        parentItem=parent,
+        annotationSortIndex=sort_index,
+        annotationText=f"Text of {key}",
+        annotationComment=parsing.LIDIAPREFIX + yaml.safe_dump(lidia),
+    )
+
+
+class ZoteroStub:
+    """In-memory Zotero library served over HTTP by ZoteroStubHandler.
+    Implements the parts of the Zotero web API used by the sync app."""
+
+    def __init__(self):
+        self.items = {}
+        self.deleted = {}
+        self.library_version = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        # Seconds to wait before answering a request
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Scripted (status, headers) pairs that are used for the next
+        # responses; a 200 status gives the regular response with the extra
+        # headers
+        self.responses = deque()
+
+    def add(self, key: str, item_type: str = "annotation", parent=None, **data):
+        """Adds or modifies an item, which bumps the library version."""
+        self.library_version += 1
+        item = make_item(key, self.library_version, itemType=item_type, **data)
+        if parent:
+            item["data"]["parentItem"] = parent
+        self.items[key] = item
+        return item
+
+    def delete(self, key: str):
+        self.library_version += 1
+        del self.items[key]
+        self.deleted[key] = self.library_version
+
+    def trash(self, key: str):
+        self.library_version += 1
+        item = self.items[key]
+        item["version"] = item["data"]["version"] = self.library_version
+        item["data"]["deleted"] = 1
+
+    def item_requests(self):
+        return [r for r in self.requests if "/items" in r[0]]
+
+    def select(self, path: str, params: dict) -> list:
+        since = int(params.get("since", -1))
+        items = [x for x in self.items.values() if x["version"] > since]
+        if path.endswith("/items/trash"):
+            items = [x for x in items if x["data"].get("deleted")]
+        elif not params.get("includeTrashed"):
+            items = [x for x in items if not x["data"].get("deleted")]
+        if path.endswith("/items/top"):
+            items = [x for x in items if "parentItem" not in x["data"]]
+        if "itemType" in params:
+            items = [
+                x for x in items if x["data"]["itemType"] == params["itemType"]
+            ]
+        if "itemKey" in params:
+            keys = params["itemKey"].split(",")
+            items = [x for x in items if x["key"] in keys]
+        return items
+
+
+class ZoteroStubHandler(BaseHTTPRequestHandler):
+    stub: ZoteroStub
+    # Keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.stub
+        with stub.lock:
+            stub.in_flight += 1
+            stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+        try:
+            time.sleep(stub.delay)
+            self.respond()
+        finally:
+            with stub.lock:
+                stub.in_flight -= 1
+
+    def respond(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        with self.stub.lock:
+            self.stub.requests.append((url.path, params))
+            status, extra_headers = (
+                self.stub.responses.popleft() if self.stub.responses
+                else (200, {})
+            )
+            items = self.stub.select(url.path, params)
+            library_version = self.stub.library_version
+        if status != 200:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            for name, value in extra_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        headers = {
+            "Last-Modified-Version": str(library_version),
+            "Total-Results": str(len(items)),
+            **extra_headers,
+        }
+        if url.path.endswith("/deleted"):
+            since = int(params["since"])
+            body = {
+                "items": [k for k, v in self.stub.deleted.items() if v > since],
+                "collections": [],
+                "searches": [],
+                "tags": [],
+                "settings": [],
+            }
+        elif params.get("format") == "versions":
+            body = {x["key"]: x["version"] for x in items}
+        else:
+            start = int(params.get("start", 0))
+            limit = int(params.get("limit", 25))
+            body = items[start:start + limit]
+            if start + limit < len(items):
+                next_params = urlencode(params | {"start": start + limit})
+                host, port = self.server.server_address[:2]
+                headers["Link"] = (
+                    f'<http://{host}:{port}{url.path}?{next_params}>; rel="next"'
+                )
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def zotero_stub():
+    stub = ZoteroStub()
+    handler = type("Handler", (ZoteroStubHandler,), {"stub": stub})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    host, port = server.server_address[:2]
+    stub.url = f"http://{host}:{port}"
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def zot(zotero_stub, settings, monkeypatch) -> zotero.Zotero:
+    """Zotero instance connected to the stub; get_zotero_instance() also
+    returns instances connected to the stub."""
+    settings.ZOTERO_LIBRARY_ID = "1"
+    settings.ZOTERO_LIBRARY_TYPE = "user"
+    get_zotero_instance = zoterosync.get_zotero_instance
+
+    def get_stub_instance(*args, **kwargs):
+        zot = get_zotero_instance(*args, **kwargs)
+        zot.endpoint = zotero_stub.url
+        return zot
+
+    monkeypatch.setattr(zoterosync, "get_zotero_instance", get_stub_instance)
+    return zoterosync.get_zotero_instance()
+
+
 def test_dummy():
     pass
+
+
+@pytest.mark.django_db
+class TestSaveItems:
+    def test_create(self):
+        counts = save_items(Publication, [make_item("AAAA"), make_item("BBBB")])
+        assert counts == (2, 0, 0)
+        assert Publication.objects.get(zotero_id="AAAA").content["key"] == "AAAA"
+
+    def test_update(self):
+        save_items(Annotation, [make_item("AAAA", annotationText="old")])
+        counts = save_items(
+            Annotation,
+            [make_item("AAAA", 2, annotationText="new"), make_item("BBBB")]
+        )
+        assert counts == (1, 1, 0)
+        assert Annotation.objects.count() == 2
+        content = Annotation.objects.get(zotero_id="AAAA").content
+        assert content["data"]["annotationText"] == "new"
+
+    def test_duplicate_keys(self):
+        counts = save_items(
+            Annotation, [make_item("AAAA", 1), make_item("AAAA", 2)]
+        )
+        assert counts == (1, 0, 0)
+        assert Annotation.objects.get(zotero_id="AAAA").content["version"] == 2
+
+    def test_empty(self):
+        assert save_items(Annotation, []) == (0, 0, 0)
+
+    def test_skip_unchanged(self, django_assert_num_queries):
+        item = make_item("AAAA", annotationText="text")
+        save_items(Annotation, [item])
+        # Same content with a different key order
+        reordered = dict(reversed(list(item.items())))
+        with django_assert_num_queries(1):
+            assert save_items(Annotation, [reordered]) == (0, 0, 1)
+        counts = save_items(
+            Annotation, [reordered, make_item("AAAA", annotationText="new")]
+        )
+        assert counts == (0, 1, 0)
+        assert Annotation.objects.get().digest == get_digest(
+            make_item("AAAA", annotationText="new")
+        )
+
+    def test_save_pages(self):
+        pages = [
+            [make_item(f"K{i:04}") for i in range(start, start + 100)]
+            for start in (0, 100)
+        ]
+        assert save_pages(Annotation, pages) == (200, 0, 0)
+        assert save_pages(Annotation, pages) == (0, 0, 200)
+
+
+@pytest.mark.django_db
+class TestStreamingSync:
+    def test_sync_annotations(self, zotero_stub, zot, monkeypatch):
+        for i in range(250):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+        zotero_stub.add("PUB1", item_type="book")
+        page_sizes = []
+
+        def save_items_spy(model, items):
+            page_sizes.append(len(items))
+            return save_items(model, items)
+
+        monkeypatch.setattr(zoterosync, "save_items", save_items_spy)
+        zoterosync.sync_annotations(zot, since=-1)
+        # Every page is written as soon as it arrives
+        assert page_sizes == [100, 100, 50]
+        assert len(zotero_stub.item_requests()) == 3
+        assert Annotation.objects.count() == 250
+
+    def test_sync_publications_since(self, zotero_stub, zot):
+        zotero_stub.add("PUB1", item_type="book")
+        zotero_stub.add("PDF1", item_type="attachment", parent="PUB1")
+        zotero_stub.add("PUB2", item_type="book")
+        zoterosync.sync_publications(zot, since=1)
+        assert list(Publication.objects.values_list("zotero_id", flat=True)) \
+            == ["PUB2"]
+
+
+@pytest.mark.django_db
+class TestSyncDeletions:
+    def test_deleted_and_trashed(self, zotero_stub, zot):
+        zotero_stub.add("PUB1", item_type="book")
+        zotero_stub.add("PUB2", item_type="book")
+        zotero_stub.add("ANN1", parent="PDF1")
+        zotero_stub.add("ANN2", parent="PDF1")
+        zoterosync.sync_publications(zot, since=-1)
+        zoterosync.sync_annotations(zot, since=-1)
+        version = zotero_stub.library_version
+        lidiamodels.Publication.objects.create(
+            zotero_publication_id="PUB1", attachment_id="PDF1"
+        )
+        lidiamodels.Annotation.objects.create(
+            zotero_annotation_id="ANN1", parent_attachment_id="PDF1"
+        )
+        zotero_stub.delete("ANN1")
+        zotero_stub.trash("PUB2")
+
+        zoterosync.sync_deletions(zot, since=version)
+        assert list(Annotation.objects.values_list("zotero_id", flat=True)) \
+            == ["ANN2"]
+        assert list(Publication.objects.values_list("zotero_id", flat=True)) \
+            == ["PUB1"]
+        assert not lidiamodels.Annotation.objects.exists()
+
+    def test_deleted_publication_cascades(self, zotero_stub, zot):
+        zotero_stub.add("PUB1", item_type="book")
+        zoterosync.sync_publications(zot, since=-1)
+        version = zotero_stub.library_version
+        lidiamodels.Publication.objects.create(
+            zotero_publication_id="PUB1", attachment_id="PDF1"
+        )
+        lidiamodels.Annotation.objects.create(parent_attachment_id="PDF1")
+        zotero_stub.delete("PUB1")
+        zoterosync.sync_deletions(zot, since=version)
+        assert not lidiamodels.Publication.objects.exists()
+        assert not lidiamodels.Annotation.objects.exists()
+
+    def test_first_sync(self, zotero_stub, zot):
+        zoterosync.sync_deletions(zot, since=-1)
+        assert not zotero_stub.requests
+
+
+@pytest.mark.django_db
+class TestSyncByVersion:
+    def test_get_changed_keys(self):
+        save_items(Annotation, [make_item("AAAA", 3), make_item("BBBB", 4)])
+        remote = {"AAAA": 3, "BBBB": 5, "CCCC": 1}
+        assert zoterosync.get_changed_keys(Annotation, remote) == ["BBBB", "CCCC"]
+
+    def test_sync_annotations(self, zotero_stub, zot):
+        for i in range(120):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+        # Local copy of the first 100 annotations is already up to date
+        save_items(Annotation, list(zotero_stub.items.values())[:100])
+        zotero_stub.add("A0000", parent="PDF1")
+
+        zoterosync.sync_annotations(zot, since=-1, by_version=True)
+        requests = zotero_stub.item_requests()
+        assert requests[0][1]["format"] == "versions"
+        batches = [r[1]["itemKey"].split(",") for r in requests[1:]]
+        assert [len(batch) for batch in batches] == [21]
+        assert "A0000" in batches[0]
+        assert Annotation.objects.count() == 120
+        assert Annotation.objects.get(zotero_id="A0000").version \
+            == zotero_stub.library_version
+
+    def test_sync_publications(self, zotero_stub, zot):
+        for i in range(60):
+            zotero_stub.add(f"P{i:04}", item_type="book")
+        zotero_stub.add("PDF1", item_type="attachment", parent="P0000")
+        zoterosync.sync_publications(zot, since=-1, by_version=True)
+        batches = [r[1]["itemKey"] for r in zotero_stub.item_requests()[1:]]
+        assert [len(batch.split(",")) for batch in batches] == [50, 10]
+        assert Publication.objects.count() == 60
+
+
+@pytest.mark.django_db
+class TestConcurrentSync:
+    def fill_library(self, zotero_stub):
+        for i in range(130):
+            zotero_stub.add(f"P{i:04}", item_type="book")
+        for i in range(450):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+
+    def test_sync(self, zotero_stub, zot, monkeypatch):
+        self.fill_library(zotero_stub)
+        zotero_stub.delay = 0.05
+        writer_threads = set()
+
+        def save_items_spy(model, items):
+            writer_threads.add(threading.current_thread())
+            return save_items(model, items)
+
+        monkeypatch.setattr(zoterosync, "save_items", save_items_spy)
+        zoterosync.sync(concurrency=3)
+        assert Publication.objects.count() == 130
+        assert Annotation.objects.count() == 450
+        assert writer_threads == {threading.main_thread()}
+        assert 1 < zotero_stub.max_in_flight <= 3
+        # Last-modified-version request plus 2 + 5 pages
+        assert len(zotero_stub.item_requests()) == 8
+
+    def test_sync_by_version(self, zotero_stub, zot):
+        self.fill_library(zotero_stub)
+        save_items(Annotation, list(zotero_stub.items.values())[130:400])
+        zoterosync.sync(by_version=True, concurrency=4)
+        assert Publication.objects.count() == 130
+        assert Annotation.objects.count() == 450
+        batches = [r[1]["itemKey"] for r in zotero_stub.item_requests()
+                   if "itemKey" in r[1]]
+        # 130 publications and 180 outdated annotations
+        assert sorted(len(b.split(",")) for b in batches) \
+            == [30, 30, 50, 50, 50, 50, 50]
+
+    def test_shared_client(self, zotero_stub, zot, monkeypatch):
+        self.fill_library(zotero_stub)
+        clients = set()
+        get_zotero_instance = zoterosync.get_zotero_instance
+
+        def get_instance_spy(*args, **kwargs):
+            zot = get_zotero_instance(*args, **kwargs)
+            clients.add(zot.client)
+            return zot
+
+        monkeypatch.setattr(zoterosync, "get_zotero_instance", get_instance_spy)
+        zoterosync.sync(concurrency=4)
+        assert len(clients) == 1
+
+
+class TestRateLimiter:
+    def test_backoff_and_grow(self):
+        limiter = RateLimiter(4)
+        limiter.backoff(0)
+        limiter.backoff(0)
+        assert limiter.concurrency == 1
+        for _ in range(limiter.grow_after * 5):
+            limiter.success()
+        assert limiter.concurrency == 4
+
+    def test_throttled_time(self):
+        limiter = RateLimiter(2)
+        limiter.backoff(0.2)
+        # Overlapping backoff periods are only counted once
+        limiter.backoff(0.1)
+        assert limiter.throttled_time == pytest.approx(0.2, abs=0.01)
+        start = time.monotonic()
+        limiter.acquire()
+        assert time.monotonic() - start >= 0.19
+        limiter.release()
+
+    def test_get_backoff_seconds(self):
+        assert get_backoff_seconds(httpx.Response(200)) is None
+        assert get_backoff_seconds(
+            httpx.Response(200, headers={"Backoff": "30"})
+        ) == 30
+        date = formatdate(time.time() + 60, usegmt=True)
+        seconds = get_backoff_seconds(
+            httpx.Response(429, headers={"Retry-After": date})
+        )
+        assert 55 < seconds <= 60
+
+
+@pytest.mark.django_db
+class TestRateLimitedSync:
+    @pytest.fixture(autouse=True)
+    def fast_retries(self, monkeypatch):
+        monkeypatch.setattr(RateLimitedTransport, "retry_delay", 0.01)
+        monkeypatch.setattr(RateLimitedTransport, "jitter", 0.1)
+
+    def test_retry_after(self, zotero_stub, zot):
+        for i in range(150):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+        limiter = RateLimiter(1)
+        zot = zoterosync.get_zotero_instance(limiter=limiter)
+        zotero_stub.responses.extend([(200, {}), (429, {"Retry-After": "0.2"})])
+        start = time.monotonic()
+        zoterosync.sync_annotations(zot, since=-1)
+        assert time.monotonic() - start >= 0.2
+        assert Annotation.objects.count() == 150
+        # The second page was requested twice
+        assert len(zotero_stub.item_requests()) == 3
+        assert limiter.n_throttled == 1
+        assert limiter.throttled_time >= 0.2
+
+    def test_retry_without_header(self, zotero_stub, zot):
+        zotero_stub.add("A0001", parent="PDF1")
+        zotero_stub.responses.extend([(503, {}), (429, {})])
+        zoterosync.sync_annotations(zot, since=-1)
+        assert Annotation.objects.count() == 1
+
+    def test_backoff_on_success(self, zotero_stub, zot):
+        for i in range(150):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+        limiter = RateLimiter(4)
+        zot = zoterosync.get_zotero_instance(limiter=limiter)
+        zotero_stub.responses.append((200, {"Backoff": "0.2"}))
+        start = time.monotonic()
+        zoterosync.sync_annotations(zot, since=-1)
+        assert time.monotonic() - start >= 0.2
+        assert len(zotero_stub.item_requests()) == 2
+        assert limiter.concurrency == 2
+
+    def test_too_many_retries(self, zotero_stub, zot, monkeypatch):
+        monkeypatch.setattr(RateLimitedTransport, "max_retries", 2)
+        zotero_stub.add("A0001", parent="PDF1")
+        zotero_stub.responses.extend([(429, {"Retry-After": "0"})] * 3)
+        with pytest.raises(zotero_errors.TooManyRetriesError):
+            zoterosync.sync_annotations(zot, since=-1)
+
+    def test_concurrent_sync(self, zotero_stub, zot, caplog):
+        for i in range(450):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+        zotero_stub.delay = 0.02
+        # Answer the first page requests with a 429
+        zotero_stub.responses.extend([(200, {}), (429, {"Retry-After": "0.1"})])
+        with caplog.at_level("INFO", logger="sync"):
+            zoterosync.sync(concurrency=4)
+        assert Annotation.objects.count() == 450
+        assert "Throttled by the Zotero API 1 times" in caplog.text
+
+
+@pytest.mark.django_db
+class TestResumableSync:
+    def fill_library(self, zotero_stub):
+        zotero_stub.add("PUB1", item_type="book")
+        for i in range(450):
+            zotero_stub.add(f"A{i:04}", parent="PDF1")
+
+    def interrupt(self, monkeypatch, after_pages: int):
+        """Let save_items fail after the given number of annotation pages."""
+        pages = []
+
+        def failing_save_items(model, items):
+            if model is Annotation:
+                if len(pages) == after_pages:
+                    raise RuntimeError("interrupted")
+                pages.append(items)
+            return save_items(model, items)
+
+        monkeypatch.setattr(zoterosync, "save_items", failing_save_items)
+
+    def annotation_starts(self, zotero_stub):
+        return sorted(
+            int(params.get("start", 0)) for path, params in zotero_stub.requests
+            if params.get("itemType") == "annotation"
+        )
+
+    @pytest.mark.parametrize("concurrency", [1, 3])
+    def test_resume(self, zotero_stub, zot, monkeypatch, concurrency):
+        self.fill_library(zotero_stub)
+        target_version = zotero_stub.library_version
+        with monkeypatch.context() as m:
+            self.interrupt(m, after_pages=2)
+            with pytest.raises(RuntimeError):
+                zoterosync.sync(concurrency=concurrency)
+        assert not Sync.objects.exists()
+        checkpoint = Checkpoint.objects.get(stream="annotations")
+        assert checkpoint.target_version == target_version
+        assert checkpoint.start > 0
+        assert Checkpoint.objects.get(stream="publications").completed
+        n_saved = Annotation.objects.count()
+        assert n_saved >= checkpoint.start
+
+        # The library is modified, but no items are removed
+        zotero_stub.add("A0000", parent="PDF1")
+        zotero_stub.requests.clear()
+        zoterosync.sync(concurrency=concurrency)
+        assert Annotation.objects.count() == 450
+        # Publications are not requested again, and annotations only from
+        # the checkpoint
+        assert not [r for r in zotero_stub.requests if r[0].endswith("/top")]
+        assert self.annotation_starts(zotero_stub)[0] == checkpoint.start
+        assert Sync.objects.get().library_version == target_version
+        assert not Checkpoint.objects.exists()
+
+    def test_start_over_after_removal(self, zotero_stub, zot, monkeypatch):
+        self.fill_library(zotero_stub)
+        with monkeypatch.context() as m:
+            self.interrupt(m, after_pages=2)
+            with pytest.raises(RuntimeError):
+                zoterosync.sync(concurrency=1)
+        assert Checkpoint.objects.get(stream="annotations").start == 200
+        zotero_stub.delete("A0000")
+        zotero_stub.requests.clear()
+        zoterosync.sync(concurrency=1)
+        assert self.annotation_starts(zotero_stub) == [0, 100, 200, 300, 400]
+        assert Annotation.objects.count() == 449
+        assert Sync.objects.get().library_version == zotero_stub.library_version
+
+
+@pytest.fixture
+def no_lexicon(monkeypatch):
+    monkeypatch.setattr(populate, "fetch_lexicon_data", lambda: None)
+    monkeypatch.setattr(populate, "load_lexicon_data", lambda: {})
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("no_lexicon")
+class TestIncrementalPopulate:
+    def fill(self):
+        save_items(Publication, [make_publication("PUB1", "PDF1")])
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="first"),
+            make_annotation("A2", "PDF1", "00002|000001|00001", argcont=True),
+            make_annotation("A3", "PDF1", "00003|000001|00001", argname="second",
+                            relationTo="A1", relationType="supports"),
+        ])
+
+    def test_only_dirty(self, django_assert_max_num_queries):
+        self.fill()
+        populate.populate()
+        assert lidiamodels.Annotation.objects.count() == 2
+        assert not Annotation.objects.filter(dirty=True).exists()
+        assert not Publication.objects.filter(dirty=True).exists()
+        cont = lidiamodels.ContinuationAnnotation.objects.get()
+        assert cont.start_annotation.lidia_id == "A1"
+        assert lidiamodels.Annotation.objects.get(lidia_id="A3").relation_to \
+            .lidia_id == "A1"
+
+        # Nothing changed: no sync objects are processed
+        with django_assert_max_num_queries(28):
+            populate.populate()
+
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", 2, argname="new"),
+        ])
+        assert Annotation.objects.filter(dirty=True).count() == 1
+        populate.populate()
+        assert lidiamodels.Annotation.objects.get(lidia_id="A1").argname == "new"
+        assert not Annotation.objects.filter(dirty=True).exists()
+
+    def test_refresh(self):
+        self.fill()
+        populate.populate()
+        lidiamodels.BaseAnnotation.objects.all().delete()
+        populate.populate()
+        assert not lidiamodels.Annotation.objects.exists()
+        populate.populate(refresh=True)
+        assert lidiamodels.Annotation.objects.count() == 2
+
+    def test_display_fields(self):
+        self.fill()
+        save_items(Annotation, [
+            make_annotation("A4", "PDF1", "00004|000001|00001", argcont=True),
+        ])
+        populate.populate()
+        values = ["pdf_page_start", "pdf_page_end", "quotation", "terms"]
+        first = lidiamodels.Annotation.objects.filter(lidia_id="A1")
+        assert first.values_list(*values).get() == \
+            (2, 3, "Text of A1\nText of A2", "")
+        second = lidiamodels.Annotation.objects.filter(lidia_id="A3")
+        assert second.values_list(*values).get() == \
+            (4, 5, "Text of A3\nText of A4", "")
+
+        # A continuation is removed by a sync
+        zoterosync.remove_items(["A4"])
+        populate.populate()
+        assert second.values_list(*values).get() == (4, 4, "Text of A3", "")
+
+        save_items(Annotation, [make_annotation(
+            "A3", "PDF1", "00003|000001|00001", 2, argname="second",
+            termgroups=[{"termtype": "definiendum", "articleterm": "word"}],
+        )])
+        populate.populate()
+        assert second.get().terms == "word/None"
+
+    def test_search_index(self):
+        self.fill()
+        save_items(Annotation, [make_annotation(
+            "A3", "PDF1", "00003|000001|00001", argname="second",
+            description="Verbs in Dutch", termgroups=[
+                {"termtype": "definiendum", "articleterm": "verbal noun"},
+            ],
+        )])
+        populate.populate()
+
+        def find(search_term):
+            return set(search.search(
+                lidiamodels.Annotation.objects.all(), search_term
+            ).values_list("lidia_id", flat=True))
+
+        # The quotation includes continuation annotations
+        assert find("A2") == {"A1"}
+        assert find("text of") == {"A1", "A3"}
+        assert find("dut verb") == {"A3"}
+        assert find("nouns") == set()
+        zoterosync.remove_items(["A3"])
+        populate.populate()
+        assert find("verbal") == set()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {search.TABLE}")
+            assert cursor.fetchone() == (1,)
+
+    def test_delete_orphans(self):
+        self.fill()
+        save_items(Annotation, [
+            make_annotation("A4", "PDF1", "00004|000001|00001", argname="third",
+                            arglang="nld", termgroups=[
+                                {"termtype": "term", "articleterm": "old",
+                                 "category": "phonology", "lidiaterm": "x"},
+                                {"termtype": "term", "articleterm": "gone"},
+                            ]),
+        ])
+        populate.populate()
+        assert lidiamodels.TermGroup.objects.count() == 2
+        assert set(lidiamodels.FacetCount.objects.filter(
+            facet="articleterm"
+        ).values_list("label", "count")) == {("old", 1), ("gone", 1)}
+        # A1 is deleted, A2 is no longer a LIDIA annotation and A4 loses a
+        # term group and its language, which is kept
+        Annotation.objects.filter(zotero_id="A1").delete()
+        save_items(Annotation, [
+            make_item("A2", 2, itemType="annotation", parentItem="PDF1",
+                      annotationComment="Just a comment"),
+            make_annotation("A4", "PDF1", "00004|000001|00001", 2,
+                            argname="third", termgroups=[
+                                {"termtype": "term", "articleterm": "new"},
+                            ]),
+        ])
+        populate.populate()
+        assert set(lidiamodels.BaseAnnotation.objects.values_list(
+            "lidia_id", flat=True
+        )) == {"A3", "A4"}
+        assert list(lidiamodels.TermGroup.objects.values_list(
+            "index", "articleterm__term"
+        )) == [(0, "new")]
+        assert list(lidiamodels.ArticleTerm.objects.values_list(
+            "term", flat=True
+        )) == ["new"]
+        assert list(lidiamodels.FacetCount.objects.filter(
+            facet="articleterm"
+        ).values_list("label", "count")) == [("new", 1)]
+        assert not lidiamodels.Category.objects.exists()
+        assert not lidiamodels.LidiaTerm.objects.exists()
+        assert set(lidiamodels.Language.objects.values_list(
+            "code", flat=True
+        )) == {"nld", "unspecified"}
+
+        Publication.objects.all().delete()
+        populate.populate()
+        assert not lidiamodels.Publication.objects.exists()
+        assert not lidiamodels.BaseAnnotation.objects.exists()
+
+    def test_relink_after_deletion(self):
+        self.fill()
+        save_items(Annotation, [
+            make_annotation("A0", "PDF1", "00000|000001|00001", argname="zero"),
+        ])
+        populate.populate()
+        cont = lidiamodels.ContinuationAnnotation.objects.get()
+        assert cont.start_annotation.lidia_id == "A1"
+        # Deleting the first annotation in Zotero leaves the continuation
+        # unlinked; it now belongs to the annotation before it
+        Annotation.objects.filter(zotero_id="A1").delete()
+        populate.populate()
+        cont.refresh_from_db()
+        assert cont.start_annotation.lidia_id == "A0"
+
+    def test_relation_target_removed(self, caplog):
+        self.fill()
+        populate.populate()
+        Annotation.objects.filter(zotero_id="A1").delete()
+        populate.populate()
+        assert "There are references to 1 non-existing annotation(s)." \
+            in caplog.text
+        three = lidiamodels.Annotation.objects.get(lidia_id="A3")
+        assert (three.relation_to, three.relation_to_lidia_id) == (None, "A1")
+        # The relation is restored when the annotation returns
+        save_items(Annotation, [make_annotation(
+            "A1", "PDF1", "00001|000001|00001", 2, argname="first"
+        )])
+        populate.populate()
+        three.refresh_from_db()
+        assert three.relation_to.lidia_id == "A1"
+
+    def test_changed_during_populate(self, monkeypatch):
+        self.fill()
+        mark_clean = populate.mark_clean
+
+        def sync_then_mark_clean(objs):
+            if objs[0].zotero_id == "A1":
+                save_items(Annotation, [make_annotation(
+                    "A1", "PDF1", "00001|000001|00001", 2, argname="new"
+                )])
+            mark_clean(objs)
+
+        monkeypatch.setattr(populate, "mark_clean", sync_then_mark_clean)
+        populate.populate()
+        assert Annotation.objects.get(dirty=True).zotero_id == "A1"
+
+
+    def test_batches(self, caplog, monkeypatch):
+        self.fill()
+        batches = []
+        save_annotations = populate.save_annotations
+
+        def save_annotations_spy(annotations, lookups):
+            batches.append([a.zotero_id for a in annotations])
+            return save_annotations(annotations, lookups)
+
+        monkeypatch.setattr(populate, "save_annotations", save_annotations_spy)
+        caplog.set_level("INFO")
+        populate.populate(batch_size=2)
+        assert batches == [["A1", "A2"], ["A3"]]
+        assert "Committed 3 batches" in caplog.text
+
+    def test_invalid_payload(self, caplog):
+        self.fill()
+        save_items(Annotation, [
+            # Description may not be null
+            make_annotation("A4", "PDF1", "00004|000001|00001", argname="bad",
+                            description=None, termgroups=[{"articleterm": "x"}]),
+            make_annotation("A5", "PDF1", "00005|000001|00001", argname="good",
+                            termgroups=[{"articleterm": "y"}]),
+        ])
+        populate.populate()
+        assert "Could not save A4" in caplog.text
+        assert set(lidiamodels.Annotation.objects.values_list("argname", flat=True)) \
+            == {"first", "second", "good"}
+        # The article term of the bad annotation was rolled back
+        assert list(lidiamodels.ArticleTerm.objects.values_list("term", flat=True)) \
+            == ["y"]
+        # The bad annotation is tried again by the next populate
+        assert list(Annotation.objects.filter(dirty=True).values_list(
+            "zotero_id", flat=True
+        )) == ["A4"]
+
+    @pytest.mark.parametrize("termgroups", ["oops", [{"articleterm": "x"}, None]])
+    def test_invalid_termgroups(self, caplog, termgroups):
+        self.fill()
+        populate.populate()
+        save_items(Annotation, [
+            make_annotation("A4", "PDF1", "00004|000001|00001", argname="bad",
+                            termgroups=termgroups),
+        ])
+        # As if the data was extracted before the structure was checked
+        Annotation.objects.filter(zotero_id="A4").update(
+            lidia_data={"argname": "bad", "termgroups": termgroups},
+            lidia_error="",
+        )
+        populate.populate()
+        assert "Invalid term groups in annotation with key A4" in caplog.text
+        assert not lidiamodels.Annotation.objects.filter(argname="bad").exists()
+        assert not Annotation.objects.filter(dirty=True).exists()
+
+    def test_failed_save_stays_dirty(self, monkeypatch):
+        self.fill()
+        save_annotations = populate.save_annotations
+
+        def save_annotations_locked(annotations, lookups):
+            if any(a.zotero_id == "A3" for a in annotations):
+                raise DatabaseError("database is locked")
+            return save_annotations(annotations, lookups)
+
+        monkeypatch.setattr(populate, "save_annotations", save_annotations_locked)
+        populate.populate()
+        assert Annotation.objects.get(dirty=True).zotero_id == "A3"
+        assert not lidiamodels.Annotation.objects.filter(lidia_id="A3").exists()
+        monkeypatch.setattr(populate, "save_annotations", save_annotations)
+        populate.populate()
+        assert not Annotation.objects.filter(dirty=True).exists()
+        assert lidiamodels.Annotation.objects.filter(lidia_id="A3").exists()
+
+    def test_start_annotation_synced_later(self, caplog):
+        save_items(Publication, [make_publication("PUB1", "PDF1")])
+        save_items(Annotation, [
+            make_annotation("A2", "PDF1", "00002|000001|00001", argcont=True),
+        ])
+        populate.populate()
+        assert "no annotation before it" in caplog.text
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="first"),
+        ])
+        populate.populate()
+        cont = lidiamodels.ContinuationAnnotation.objects.get(lidia_id="A2")
+        assert cont.start_annotation.lidia_id == "A1"
+        assert not Annotation.objects.filter(dirty=True).exists()
+
+    def test_numeric_ids(self):
+        save_items(Publication, [make_publication("PUB1", "PDF1")])
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", lidiaId=123,
+                            arglang=456),
+            make_annotation("A2", "PDF1", "00002|000001|00001", relationTo=123,
+                            relationType="supports"),
+        ])
+        populate.populate()
+        one = lidiamodels.Annotation.objects.get(lidia_id="123")
+        assert one.arglang_id == "456"
+        assert lidiamodels.Annotation.objects.get(lidia_id="A2").relation_to == one
+        assert not Annotation.objects.filter(dirty=True).exists()
+        # Nothing is recreated the second time
+        Annotation.objects.update(dirty=True)
+        populate.populate()
+        assert lidiamodels.Annotation.objects.get(lidia_id="123").pk == one.pk
+
+    def test_missing_publication(self, caplog):
+        self.fill()
+        save_items(Annotation, [
+            make_annotation("A4", "PDF2", "00001|000001|00001", argname="early"),
+            make_annotation("A5", "PDF1", "00005|000001|00001", argname="good"),
+        ])
+        populate.populate()
+        assert "publication PDF2 does not exist" in caplog.text
+        assert lidiamodels.Annotation.objects.filter(argname="good").exists()
+        assert Annotation.objects.get(dirty=True).zotero_id == "A4"
+        # The annotation is saved once its publication is synced
+        save_items(Publication, [make_publication("PUB2", "PDF2")])
+        populate.populate()
+        assert lidiamodels.Annotation.objects.get(argname="early") \
+            .parent_attachment_id == "PDF2"
+        assert not Annotation.objects.filter(dirty=True).exists()
+
+
+    def test_workers(self, caplog):
+        self.fill()
+        save_items(Annotation, [
+            make_item("A4", annotationComment=parsing.LIDIAPREFIX + "a: [b"),
+            make_item("A5", annotationComment="Not for LIDIA"),
+        ] + [
+            make_annotation(f"B{i:03}", "PDF1", f"{i:05}|000002|00001",
+                            argname=f"B{i}")
+            for i in range(250)
+        ])
+        # As if synced before the LIDIA data was extracted during the sync
+        Annotation.objects.update(is_lidia=None, lidia_data=None)
+        caplog.set_level("INFO")
+        populate.populate(batch_size=100, workers=2)
+        assert lidiamodels.Annotation.objects.count() == 252
+        assert "YAMLError: " in caplog.text
+        assert "Ignoring 1 annotations that are not LIDIA annotations." \
+            in caplog.text
+        assert Annotation.objects.get(zotero_id="B000").lidia_data \
+            == {"argname": "B0"}
+        assert not Annotation.objects.filter(is_lidia__isnull=True).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.usefixtures("no_lexicon")
+class TestShadow:
+    def fill(self):
+        save_items(Publication, [make_publication("PUB1", "PDF1")])
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="first"),
+            make_annotation("A2", "PDF1", "00002|000001|00001", argname="second"),
+        ])
+        populate.populate()
+
+    def test_build(self, tmp_path, monkeypatch):
+        self.fill()
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", 2, argname="new"),
+        ])
+        live = sqlite3.connect(connection.settings_dict["NAME"], uri=True)
+        build = shadow.populate
+
+        def populate_shadow(**kwargs):
+            build(**kwargs)
+            # The search index is copied from the shadow, not rebuilt
+            monkeypatch.setattr(search, "update_index", None)
+            # The live database keeps the previous data during the build
+            assert live.execute(
+                "SELECT argname FROM lidia_annotation ORDER BY argname"
+            ).fetchall() == [("first",), ("second",)]
+            # An annotation is removed from Zotero in the meantime
+            with live:
+                live.execute("DELETE FROM sync_annotation WHERE zotero_id = 'A2'")
+
+        monkeypatch.setattr(shadow, "populate", populate_shadow)
+        path = tmp_path / "shadow.sqlite3"
+        generation = get_generation()
+        shadow.build_shadow(path)
+        live.close()
+        assert get_generation() == generation + 1
+        assert not list(tmp_path.iterdir())
+        assert [a.lidia_id for a in search.search(
+            lidiamodels.Annotation.objects.all(), "new"
+        )] == ["A1"]
+        assert not path.exists()
+        assert list(lidiamodels.Annotation.objects.values_list(
+            "lidia_id", "argname"
+        )) == [("A1", "new")]
+        assert not Annotation.objects.filter(dirty=True).exists()
+
+    def test_use_database(self, tmp_path):
+        live = connections["default"]
+        name = live.settings_dict["NAME"]
+        with shadow.use_database(tmp_path / "other.sqlite3"):
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                assert cursor.fetchone() == ("wal",)
+            assert connection.settings_dict["NAME"] == str(tmp_path / "other.sqlite3")
+            assert live.settings_dict["NAME"] == name
+        assert connections["default"] is live
+
+    def test_read_during_swap(self, tmp_path, monkeypatch):
+        path = tmp_path / "live.sqlite3"
+        with shadow.use_database(path):
+            call_command("migrate", verbosity=0)
+            self.fill()
+            save_items(Annotation, [
+                make_annotation("A1", "PDF1", "00001|000001|00001", 2,
+                                argname="new"),
+            ])
+            reader = sqlite3.connect(path, timeout=0)
+            seen = []
+            delete_orphans = shadow.delete_orphans
+
+            def delete_and_read():
+                delete_orphans()
+                # The swap has not been committed yet
+                seen.extend(reader.execute(
+                    "SELECT argname FROM lidia_annotation ORDER BY argname"
+                ).fetchall())
+
+            monkeypatch.setattr(shadow, "delete_orphans", delete_and_read)
+            shadow.build_shadow(tmp_path / "shadow.sqlite3")
+            assert seen == [("first",), ("second",)]
+            assert reader.execute(
+                "SELECT argname FROM lidia_annotation ORDER BY argname"
+            ).fetchall() == [("new",), ("second",)]
+            reader.close()
+
+    def test_invalid(self, tmp_path, monkeypatch):
+        self.fill()
+
+        def populate_invalid(**kwargs):
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA foreign_keys = OFF")
+                cursor.execute(
+                    "UPDATE lidia_termgroup SET annotation_id = 999"
+                )
+                cursor.execute(
+                    "INSERT INTO lidia_termgroup (annotation_id, \"index\", "
+                    "termtype) VALUES (999, 0, 'term')"
+                )
+
+        monkeypatch.setattr(shadow, "populate", populate_invalid)
+        path = tmp_path / "shadow.sqlite3"
+        with pytest.raises(shadow.ShadowError):
+            shadow.build_shadow(path)
+        assert not path.exists()
+        assert not lidiamodels.TermGroup.objects.exists()
+        assert lidiamodels.Annotation.objects.count() == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("no_lexicon")
+class TestSaveAnnotations:
+    termgroups = [
+        {"articleterm": "word", "termtype": "definiendum",
+         "lexiconterm": "custom", "customterm": "own"},
+        {"articleterm": "other", "category": "semantics"},
+    ]
+
+    @pytest.fixture(autouse=True)
+    def publications(self):
+        save_items(Publication, [
+            make_publication("PUB1", "PDF1"), make_publication("PUB2", "PDF2")
+        ])
+        populate.save_publications(list(Publication.objects.all()))
+
+    def save(self, *items) -> Tuple[Set[str], Set[int]]:
+        save_items(Annotation, items)
+        return populate.save_annotations(
+            list(Annotation.objects.order_by("pk")), populate.Lookups()
+        )
+
+    def test_save(self):
+        attachments, skipped = self.save(
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="one",
+                            arglang="nld", termgroups=self.termgroups),
+            make_annotation("A2", "PDF1", "00002|000001|00001", argcont=True),
+            make_annotation("A3", "PDF2", "00001|000001|00001", lidiaId="L3",
+                            relationTo="A1", relationType="supports"),
+            make_annotation("A4", "PDF2", "00002|000001|00001",
+                            relationTo="missing"),
+            make_annotation("A5", "PDF9", "00001|000001|00001"),
+        )
+        assert attachments == {"PDF1", "PDF2"}
+        # The publication of A5 does not exist
+        assert skipped == {Annotation.objects.get(zotero_id="A5").pk}
+        one = lidiamodels.Annotation.objects.get(lidia_id="A1")
+        assert (one.argname, one.arglang.name) == ("one", "Dutch")
+        assert one.textselection == "Text of A1"
+        assert [str(tg) for tg in one.termgroups.order_by("index")] \
+            == ["word/own", "other/None"]
+        cont = lidiamodels.ContinuationAnnotation.objects.get()
+        assert cont.lidia_id == "A2"
+        assert cont.parent_attachment_id == "PDF1"
+        three = lidiamodels.Annotation.objects.get(zotero_annotation="A3")
+        assert three.lidia_id == "L3"
+        assert three.relation_to_lidia_id == "A1"
+        # No placeholder for the missing annotation
+        assert lidiamodels.BaseAnnotation.objects.count() == 4
+        assert populate.resolve_relations() == 1
+        three.refresh_from_db()
+        assert three.relation_to == one
+        four = lidiamodels.Annotation.objects.get(lidia_id="A4")
+        assert (four.relation_to, four.relation_to_lidia_id) == (None, "missing")
+
+    def test_update(self):
+        self.save(
+            make_annotation("A1", "PDF1", "00001|000001|00001",
+                            termgroups=self.termgroups),
+            make_annotation("A2", "PDF1", "00002|000001|00001", argcont=True),
+            make_annotation("A3", "PDF1", "00003|000001|00001", lidiaId="L3"),
+        )
+        termgroup = lidiamodels.TermGroup.objects.get(index=0)
+        self.save(
+            # Annotation becomes continuation and vice versa
+            make_annotation("A1", "PDF1", "00001|000001|00001", 2, argcont=True),
+            make_annotation("A2", "PDF1", "00002|000001|00001", 2,
+                            argname="two", termgroups=self.termgroups[1:]),
+            # Changed LIDIA ID
+            make_annotation("A3", "PDF1", "00003|000001|00001", 2, lidiaId="M3"),
+        )
+        assert lidiamodels.ContinuationAnnotation.objects.get().lidia_id == "A1"
+        two = lidiamodels.Annotation.objects.get(lidia_id="A2")
+        assert two.argname == "two"
+        assert str(two.termgroups.get()) == "other/None"
+        assert not lidiamodels.TermGroup.objects.filter(pk=termgroup.pk).exists()
+        assert set(lidiamodels.BaseAnnotation.objects.values_list(
+            "lidia_id", flat=True
+        )) == {"A1", "A2", "M3"}
+
+    def test_num_queries(self, django_assert_max_num_queries):
+        items = [
+            make_annotation(f"A{i:03}", "PDF1", f"{i:05}|000001|00001",
+                            relationTo="A000", termgroups=self.termgroups)
+            for i in range(200)
+        ]
+        save_items(Annotation, items)
+        annotations = list(Annotation.objects.all())
+        lookups = populate.Lookups()
+        with django_assert_max_num_queries(27):
+            populate.save_annotations(annotations, lookups)
+        assert lidiamodels.TermGroup.objects.count() == 400
+        with django_assert_max_num_queries(3):
+            populate.resolve_relations()
+        assert lidiamodels.Annotation.objects.filter(
+            relation_to__lidia_id="A000"
+        ).count() == 200
+
+
+@pytest.mark.django_db
+class TestContinuationAnnotations:
+    @pytest.fixture(autouse=True)
+    def annotations(self):
+        for attachment in ["PDF1", "PDF2"]:
+            lidiamodels.Publication.objects.create(attachment_id=attachment)
+        # Continuation annotations before, between and after two annotations
+        # in PDF1, and one after a single annotation in PDF2
+        self.orphan = self.create(lidiamodels.ContinuationAnnotation, "PDF1", 0)
+        self.first = self.create(lidiamodels.Annotation, "PDF1", 1)
+        self.conts1 = [
+            self.create(lidiamodels.ContinuationAnnotation, "PDF1", i)
+            for i in (2, 3)
+        ]
+        self.second = self.create(lidiamodels.Annotation, "PDF1", 4)
+        self.conts2 = [self.create(lidiamodels.ContinuationAnnotation, "PDF1", 5)]
+        self.third = self.create(lidiamodels.Annotation, "PDF2", 0)
+        self.conts3 = [self.create(lidiamodels.ContinuationAnnotation, "PDF2", 1)]
+
+    def create(self, model, attachment: str, index: int):
+        return model.objects.create(
+            lidia_id=f"{attachment}-{index}",
+            parent_attachment_id=attachment,
+            sort_index=f"{index:05}|000001|00001",
+        )
+
+    def start_annotations(self, conts):
+        return [
+            lidiamodels.ContinuationAnnotation.objects.get(pk=c.pk).start_annotation
+            for c in conts
+        ]
+
+    def test_link(self, django_assert_num_queries):
+        # Select and update
+        with django_assert_num_queries(2):
+            populate.process_continuation_annotations()
+        assert self.start_annotations(self.conts1) == [self.first, self.first]
+        assert self.start_annotations(self.conts2) == [self.second]
+        assert self.start_annotations(self.conts3) == [self.third]
+        # The orphan is kept, to be linked when an annotation precedes it
+        assert self.start_annotations([self.orphan]) == [None]
+        # Nothing changes the second time
+        with django_assert_num_queries(1):
+            populate.process_continuation_annotations()
+
+    def test_attachments(self):
+        populate.process_continuation_annotations(["PDF2"])
+        assert self.start_annotations(self.conts1) == [None, None]
+        assert self.start_annotations(self.conts3) == [self.third]
+        assert lidiamodels.BaseAnnotation.objects.filter(
+            pk=self.orphan.pk
+        ).exists()
+
+
+@pytest.mark.django_db
+class TestLookups:
+    termgroups = [
+        {"articleterm": "word", "category": "custom", "customcategory": "mine",
+         "lexiconterm": "custom", "customterm": "own"},
+        {"articleterm": "word", "category": "semantics", "lexiconterm": "meaning"},
+        {"articleterm": "", "lexiconterm": "custom", "customterm": ""},
+    ]
+
+    def test_prepare(self, django_assert_num_queries):
+        word = lidiamodels.ArticleTerm.objects.create(term="word")
+        lookups = populate.Lookups()
+        # One insert and one select for each of the other two tables
+        with django_assert_num_queries(4):
+            lookups.prepare(self.termgroups)
+        own = lidiamodels.LidiaTerm.objects.get(term="own")
+        with django_assert_num_queries(0):
+            assert lookups.articleterms.get("word") == word.pk
+            assert lookups.categories.get(None) is None
+            assert lookups.lidiaterms.get(("custom", "own")) == own.pk
+        assert set(lidiamodels.Category.objects.values_list("category", flat=True)) \
+            == {"mine", "semantics"}
+
+    def test_numeric_keys(self):
+        termgroups = [{"articleterm": 1984, "category": "custom",
+                       "customcategory": 42, "lexiconterm": "custom",
+                       "customterm": 7}]
+        lookups = populate.Lookups()
+        lookups.prepare(termgroups)
+        termgroup = populate.make_term_group(1, 0, termgroups[0], lookups)
+        assert termgroup.articleterm_id == \
+            lidiamodels.ArticleTerm.objects.get(term="1984").pk
+        assert termgroup.category_id == \
+            lidiamodels.Category.objects.get(category="42").pk
+        assert termgroup.lidiaterm_id == \
+            lidiamodels.LidiaTerm.objects.get(vocab="custom", term="7").pk
+
+    def test_language_name(self):
+        lookups = populate.Lookups()
+        lookups.languages.ensure(["nld", "unspecified"])
+        assert lidiamodels.Language.objects.get(code="nld").name == "Dutch"
+        assert lidiamodels.Language.objects.get(code="unspecified").name is None
+
+    def test_lidiaterm_urls(self):
+        urls = [{"vocab": "ull", "term": "Meaning", "url": "https://example.org"}]
+        lidiamodels.LexiconEntry.objects.create(slug="meaning", urls=urls)
+        lookups = populate.Lookups()
+        lookups.prepare(self.termgroups)
+        assert lidiamodels.LidiaTerm.objects.get(term="meaning").urls == urls
+        assert lidiamodels.LidiaTerm.objects.get(term="own").urls is None
+
+
+class TestParsing:
+    def test_extract(self):
+        results = parsing.extract_comments([
+            ("A1", parsing.LIDIAPREFIX + "argname: one\npagestart: 2020-01-01"),
+            ("A2", parsing.LIDIAPREFIX + "argname: [one"),
+            ("A3", parsing.LIDIAPREFIX + "- one"),
+            ("A4", "Not for LIDIA"),
+            ("A5", parsing.LIDIAPREFIX + "termgroups: oops"),
+            ("A6", parsing.LIDIAPREFIX + "termgroups:\n- articleterm: x\n- null"),
+        ])
+        assert results[0] == (
+            True, {"argname": "one", "pagestart": "2020-01-01"}, ""
+        )
+        is_lidia, data, error = results[1]
+        assert (is_lidia, data) == (True, None)
+        assert error.startswith("YAMLError: ") and "flow sequence" in error
+        assert results[2] == (
+            True, None, "Invalid LIDIA data in annotation with key A3"
+        )
+        assert results[3] == (False, None, "")
+        assert results[4] == (
+            True, None, "Invalid term groups in annotation with key A5"
+        )
+        assert results[5] == (
+            True, None, "Invalid term groups in annotation with key A6"
+        )
+
+    def test_loader(self):
+        if yaml.__with_libyaml__:
+            assert parsing.SafeLoader is yaml.CSafeLoader
+        # Both loaders are safe
+        with pytest.raises(yaml.YAMLError):
+            parsing.load_lidia_comment("!!python/object:os.system {}")
+
+    @pytest.mark.django_db
+    def test_sync(self):
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="one"),
+            make_item("A2", annotationComment="Not for LIDIA"),
+            make_item("A3"),
+        ])
+        assert list(Annotation.objects.order_by("zotero_id").values_list(
+            "is_lidia", "lidia_data", "lidia_error"
+        )) == [
+            (True, {"argname": "one"}, ""),
+            (False, None, ""),
+            (False, None, ""),
+        ]
+
+
+class LexiconHandler(BaseHTTPRequestHandler):
+    """Serves the workbook in the `content` attribute of the server with an
+    ETag and answers conditional requests."""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.path != "/lexicon.xlsx":
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha256(self.server.content).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(usegmt=True))
+        self.send_header("Content-Length", str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_workbook(rows) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "entries"
+    sheet.append(["slug", "ull", "ull-url", "ccr", "ccr-url"])
+    for row in rows:
+        sheet.append(row)
+    f = io.BytesIO()
+    workbook.save(f)
+    return f.getvalue()
+
+
+@pytest.fixture
+def lexicon_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LexiconHandler)
+    server.requests = []
+    server.content = make_workbook([
+        ["meaning", "Meaning", "https://example.org/ull/1", None, None],
+        ["form", None, None, "Form", "https://example.org/ccr/2"],
+    ])
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    host, port = server.server_address[:2]
+    server.url = f"http://{host}:{port}/lexicon.xlsx"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestLexicon:
+    def test_fetch(self, lexicon_server, tmp_path):
+        path = str(tmp_path / "data" / "lexicon.xlsx")
+        assert lexicon.fetch_lexicon(lexicon_server.url, path)
+        assert not lexicon.fetch_lexicon(lexicon_server.url, path)
+        assert "If-None-Match" in lexicon_server.requests[1]
+        assert "If-Modified-Since" in lexicon_server.requests[1]
+        lexicon_server.content = make_workbook([["new", None, None, None, None]])
+        assert lexicon.fetch_lexicon(lexicon_server.url, path)
+        assert lexicon.load_lexicon(path) == {"new": []}
+
+    def test_fetch_error(self, lexicon_server, tmp_path, caplog):
+        path = str(tmp_path / "lexicon.xlsx")
+        lexicon.fetch_lexicon(lexicon_server.url, path)
+        assert not lexicon.fetch_lexicon(lexicon_server.url + "/missing", path)
+        assert "Error downloading lexicon spreadsheet" in caplog.text
+        # The existing copy is kept
+        assert "meaning" in lexicon.load_lexicon(path)
+
+    def test_load(self, lexicon_server, tmp_path, monkeypatch):
+        path = str(tmp_path / "lexicon.xlsx")
+        lexicon.fetch_lexicon(lexicon_server.url, path)
+        expected = {
+            "meaning": [{"vocab": "ull", "term": "Meaning",
+                         "url": "https://example.org/ull/1"}],
+            "form": [{"vocab": "ccr", "term": "Form",
+                      "url": "https://example.org/ccr/2"}],
+        }
+        assert lexicon.load_lexicon(path) == expected
+        # The second time the sidecar is used
+        monkeypatch.setattr(openpyxl, "load_workbook", None)
+        assert lexicon.load_lexicon(path) == expected
+
+    def test_load_missing(self, tmp_path):
+        assert lexicon.load_lexicon(str(tmp_path / "lexicon.xlsx")) == {}
+
+
+@pytest.mark.django_db
+class TestUpdateLexicon:
+    def urls(self, term: str):
+        return lidiamodels.LidiaTerm.objects.get(vocab="lidia", term=term).urls
+
+    def test_update(self, django_assert_num_queries):
+        old = [{"vocab": "ull", "term": "Old", "url": "https://example.org/1"}]
+        new = [{"vocab": "ull", "term": "New", "url": "https://example.org/2"}]
+        populate.update_lexicon({"meaning": old, "form": old, "gone": old})
+        for term in ["meaning", "form", "gone", "other"]:
+            lidiamodels.LidiaTerm.objects.create(vocab="lidia", term=term)
+        lidiamodels.LidiaTerm.objects.create(vocab="custom", term="meaning")
+        # Select, upsert, delete and update of the LIDIA terms
+        with django_assert_num_queries(4):
+            populate.update_lexicon({"meaning": new, "form": old, "added": new})
+        assert self.urls("meaning") == new
+        # Unchanged entries are not touched; terms were created without URLs
+        assert self.urls("form") is None
+        assert self.urls("gone") is None
+        assert lidiamodels.LidiaTerm.objects.get(vocab="custom").urls is None
+        assert set(lidiamodels.LexiconEntry.objects.values_list("slug", flat=True)) \
+            == {"meaning", "form", "added"}
+        with django_assert_num_queries(1):
+            populate.update_lexicon({"meaning": new, "form": old, "added": new})
+
+    def test_empty(self):
+        populate.update_lexicon({"meaning": []})
+        populate.update_lexicon({})
+        assert lidiamodels.LexiconEntry.objects.count() == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("no_lexicon")
+class TestSyncAdmin:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+
+    def get_counts(self, client, url) -> int:
+        """Returns the number of COUNT queries of a request."""
+        with CaptureQueriesContext(connection) as queries:
+            assert client.get(url).status_code == 200
+        return sum("COUNT" in q["sql"] for q in queries)
+
+    def test_cached_count(self, admin_client):
+        url = reverse("admin:sync_annotation_changelist")
+        save_items(Publication, [make_publication("PUB1", "PDF1")])
+        save_items(Annotation, [
+            make_annotation("A1", "PDF1", "00001|000001|00001", argname="first"),
+        ])
+        assert self.get_counts(admin_client, url) == 1
+        assert self.get_counts(admin_client, url) == 0
+        populate.populate()
+        assert self.get_counts(admin_client, url) == 1
+
+        generation = get_generation()
+        response = admin_client.post(url, {
+            "action": "delete_selected",
+            "_selected_action": [Annotation.objects.get(zotero_id="A1").pk],
+            "post": "yes",
+        })
+        assert response.status_code == 302
+        assert get_generation() == generation + 1
+        assert admin_client.get(url).context["cl"].result_count == 0
@@ -1,70 +1,532 @@
 from django.conf import settings
+from django.db import models, transaction
 
+import hashlib
+import json
 import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import (
+    Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple,
+    Type,
+)
+
+import httpx
 from pyzotero import zotero
 
-from sync.models import Annotation, Publication, Sync
+from sync.models import (
+    Annotation,
+    Checkpoint,
+    Publication,
+    Sync,
+    bump_generation,
+)
+from sync.parsing import extract_item
+from sync.ratelimit import RateLimitedTransport, RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Number of items requested per API page (the maximum the Zotero API allows)
+# and therefore written per upsert statement
+PAGE_SIZE = 100
+# Maximum number of keys in a single IN clause
+KEYS_PER_QUERY = 500
+# Maximum number of keys in the itemKey parameter of a Zotero API request
+KEYS_PER_REQUEST = 50
+# Parameters for paginated requests. Sorting on date added keeps the offset
+# of an item stable when other items are modified during the sync.
+PAGE_PARAMS = {"limit": PAGE_SIZE, "sort": "dateAdded", "direction": "asc"}
+
 
-def get_zotero_instance() -> zotero.Zotero:
-    return zotero.Zotero(
+def get_zotero_instance(
+    client: Optional[httpx.Client] = None,
+    limiter: Optional[RateLimiter] = None,
+) -> zotero.Zotero:
+    """Returns a Zotero API instance. If client is given, the instance uses
+    that HTTP client, so that several instances can share a single pool of
+    keep-alive connections. Otherwise a client is created of which the
+    requests are paced and retried according to the Backoff and Retry-After
+    headers of the Zotero API, using the given or a new RateLimiter."""
+    zot = zotero.Zotero(
         settings.ZOTERO_LIBRARY_ID,
         settings.ZOTERO_LIBRARY_TYPE,
         settings.ZOTERO_API_KEY,
         preserve_json_order=True,
     )
+    if client is None:
+        if limiter is None:
+            limiter = RateLimiter(settings.ZOTERO_SYNC_CONCURRENCY)
+        client = httpx.Client(
+            headers=zot.default_headers(),
+            follow_redirects=True,
+            transport=RateLimitedTransport(limiter),
+        )
+    zot.client.close()
+    zot.client = client
+    return zot
 
 
-def sync_publications(zot: zotero.Zotero, since: int):
-    """Fetches publications which have been updated since the given library version.
-    Saves the publications to database.
-    """
+def fetch_publications(zot: zotero.Zotero, **params) -> Any:
+    """Requests top-level items with the given parameters."""
     # All publications should be placed top-level (not in collections)
     # Non-publication items might exist as well but can be ignored.
     # (There's no way to filter on bibliographic items in general directly?)
-    items = zot.everything(zot.top(since=since))
-    n_created = 0
-    n_updated = 0
-    for item in items:
-        key = item["key"]
-        obj = item
-        # Annotations are linked to their parent PDF, not the bibliographic
-        # item
-        # Assuming only one attachment per publication
-        publication, created = Publication.objects.get_or_create(zotero_id=key)
-        publication.content = obj
-        publication.save()
-        if created:
-            n_created += 1
-        else:
-            n_updated += 1
-    logging.info(
-        f"Updated {n_updated} publications; added {n_created} new publications."
+    # Annotations are linked to their parent PDF, not the bibliographic
+    # item
+    # Assuming only one attachment per publication
+    return zot.top(**params)
+
+
+def fetch_annotations(zot: zotero.Zotero, **params) -> Any:
+    """Requests items of type 'annotation' with the given parameters."""
+    return zot.items(itemType="annotation", **params)
+
+
+def fetch_versions(
+    zot: zotero.Zotero, fetch: Callable[..., Any], since: int
+) -> Dict[str, int]:
+    """Requests the versions of all items changed since the given library
+    version, without the item data."""
+    return fetch(zot, since=since, format="versions", limit=None)
+
+
+def fetch_by_key(zot: zotero.Zotero, keys: List[str]) -> List[dict]:
+    """Requests the full data of at most KEYS_PER_REQUEST items."""
+    return zot.items(itemKey=",".join(keys), limit=KEYS_PER_REQUEST)
+
+
+def fetch_page(
+    zot: zotero.Zotero, fetch: Callable[..., Any], since: int, start: int = 0
+) -> List[dict]:
+    """Requests the page of changed items starting at the given offset."""
+    return fetch(zot, since=since, start=start, **PAGE_PARAMS)
+
+
+def fetch_first_page(
+    zot: zotero.Zotero, fetch: Callable[..., Any], since: int, start: int = 0
+) -> Tuple[List[dict], int]:
+    """Requests the first page of changed items that is needed. Returns the
+    items and the total number of changed items."""
+    items = fetch_page(zot, fetch, since, start)
+    return items, int(zot.request.headers.get("Total-Results", 0))
+
+
+# Item streams that are synchronized: name -> (sync model, fetch function)
+STREAMS: Dict[str, Tuple[Type[models.Model], Callable[..., Any]]] = {
+    "publications": (Publication, fetch_publications),
+    "annotations": (Annotation, fetch_annotations),
+}
+
+
+def get_digest(item: dict) -> str:
+    """Returns a digest of the JSON of a Zotero item that does not depend on
+    the order of the keys."""
+    data = json.dumps(item, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# Fields of sync models that are derived from the content of the item
+DERIVED_FIELDS: Dict[Type[models.Model], List[str]] = {
+    Annotation: ["is_lidia", "lidia_data", "lidia_error"],
+}
+
+
+def get_derived_fields(model: Type[models.Model], item: dict) -> Dict[str, Any]:
+    """Returns the values of the DERIVED_FIELDS of the given model for an
+    item. For annotations, the LIDIA data is extracted from the comment, so
+    that populate does not need to parse it."""
+    if model is Annotation:
+        return dict(zip(DERIVED_FIELDS[model], extract_item(item)))
+    return {}
+
+
+def save_items(
+    model: Type[models.Model], items: Iterable[dict]
+) -> Tuple[int, int, int]:
+    """Upserts a batch of Zotero items into the given sync model (Publication
+    or Annotation) using a single INSERT ... ON CONFLICT statement. Items of
+    which the stored content is identical are not written; the others are
+    marked dirty, so that the next populate processes them.
+    Returns the number of created, updated and unchanged objects.
+    """
+    # Deduplicate by key; if an item occurs twice the last one wins
+    contents = {item["key"]: item for item in items}
+    if not contents:
+        return 0, 0, 0
+    digests = {key: get_digest(item) for key, item in contents.items()}
+    stored_digests = dict(
+        model.objects.filter(zotero_id__in=contents.keys())
+        .values_list("zotero_id", "digest")
     )
+    changed = [key for key in contents if stored_digests.get(key) != digests[key]]
+    if changed:
+        objs = [
+            model(
+                zotero_id=key,
+                content=contents[key],
+                version=contents[key].get("version", 0),
+                digest=digests[key],
+                dirty=True,
+                **get_derived_fields(model, contents[key]),
+            )
+            for key in changed
+        ]
+        model.objects.bulk_create(
+            objs,
+            update_conflicts=True,
+            unique_fields=["zotero_id"],
+            update_fields=[
+                "content", "version", "digest", "dirty",
+                *DERIVED_FIELDS.get(model, []),
+            ],
+        )
+    n_created = len(contents) - len(stored_digests)
+    return n_created, len(changed) - n_created, len(contents) - len(changed)
+
+
+def iter_pages(zot: zotero.Zotero, first_page: List[dict]) -> Iterator[List[dict]]:
+    """Yields the first page of a paginated request and then follows the
+    'next' links one page at a time, so that only a single page has to be
+    kept in memory."""
+    yield first_page
+    while zot.links and zot.links.get("next"):
+        yield zot.follow()
+
+
+def get_changed_keys(
+    model: Type[models.Model], remote_versions: Dict[str, int]
+) -> List[str]:
+    """Compares a mapping of Zotero keys to item versions with the versions
+    stored locally and returns the keys of items that are missing or have
+    a different version."""
+    keys = list(remote_versions)
+    local_versions = {}
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        local_versions.update(
+            model.objects.filter(
+                zotero_id__in=keys[start:start + KEYS_PER_QUERY]
+            ).values_list("zotero_id", "version")
+        )
+    return [
+        key for key in keys if local_versions.get(key) != remote_versions[key]
+    ]
+
+
+def iter_pages_by_key(zot: zotero.Zotero, keys: List[str]) -> Iterator[List[dict]]:
+    """Fetches the full data of the given items in batches of
+    KEYS_PER_REQUEST keys."""
+    for start in range(0, len(keys), KEYS_PER_REQUEST):
+        yield fetch_by_key(zot, keys[start:start + KEYS_PER_REQUEST])
+
+
+def get_outdated_keys(
+    model: Type[models.Model], remote_versions: Dict[str, int]
+) -> List[str]:
+    """Returns the keys that need to be downloaded and logs how many items
+    are skipped because they are up to date."""
+    keys = get_changed_keys(model, remote_versions)
+    n_skipped = len(remote_versions) - len(keys)
+    if n_skipped:
+        logger.info(
+            f"Skipping {n_skipped} {model._meta.verbose_name_plural} "
+            "that are already up to date."
+        )
+    return keys
+
+
+def iter_changed_pages(
+    zot: zotero.Zotero, model: Type[models.Model], remote_versions: Dict[str, int]
+) -> Iterator[List[dict]]:
+    """Yields pages containing only the items of which the local version is
+    outdated."""
+    yield from iter_pages_by_key(zot, get_outdated_keys(model, remote_versions))
+
+
+def save_checkpoint(checkpoint: Checkpoint, start: int) -> None:
+    checkpoint.start = start
+    checkpoint.save(update_fields=["start"])
+
+
+def complete_checkpoint(checkpoint: Optional[Checkpoint]) -> None:
+    if checkpoint:
+        checkpoint.completed = True
+        checkpoint.save(update_fields=["completed"])
+
+
+def save_pages(
+    model: Type[models.Model],
+    pages: Iterable[List[dict]],
+    checkpoint: Optional[Checkpoint] = None,
+) -> Tuple[int, int, int]:
+    """Saves each page of items as soon as it arrives. Returns the number of
+    created, updated and unchanged objects.
+    If a checkpoint is given, the pages are assumed to be consecutive pages
+    starting at the offset of the checkpoint, which is advanced in the same
+    transaction in which each page is saved."""
+    counts = [0, 0, 0]
+    for page in pages:
+        with transaction.atomic():
+            page_counts = save_items(model, page)
+            if checkpoint:
+                save_checkpoint(checkpoint, checkpoint.start + PAGE_SIZE)
+        counts = [n + m for n, m in zip(counts, page_counts)]
+    return tuple(counts)
 
 
-def sync_annotations(zot: zotero.Zotero, since: int):
+def log_counts(
+    stream: str, n_created: int, n_updated: int, n_unchanged: int = 0
+) -> None:
+    logger.info(f"Updated {n_updated} {stream}; added {n_created} new {stream}.")
+    if n_unchanged:
+        logger.info(f"Skipped {n_unchanged} unchanged {stream}.")
+
+
+def sync_stream(
+    zot: zotero.Zotero,
+    stream: str,
+    since: int,
+    by_version: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+) -> None:
+    """Fetches the items of the given stream which have been updated since
+    the given library version, one page at a time, and saves them to the
+    database.
+    If by_version is True, first fetch only the versions of the changed items
+    and then download the items of which the local version is outdated.
+    Otherwise, if a checkpoint is given, continue from its offset and keep
+    it up to date.
+    """
+    model, fetch = STREAMS[stream]
+    if by_version:
+        versions = fetch_versions(zot, fetch, since)
+        pages = iter_changed_pages(zot, model, versions)
+        checkpoint = None
+    elif checkpoint and checkpoint.completed:
+        return
+    else:
+        start = checkpoint.start if checkpoint else 0
+        pages = iter_pages(zot, fetch_page(zot, fetch, since, start))
+    log_counts(stream, *save_pages(model, pages, checkpoint))
+    complete_checkpoint(checkpoint)
+
+
+def sync_publications(
+    zot: zotero.Zotero,
+    since: int,
+    by_version: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+):
+    """Fetches publications which have been updated since the given library version.
+    Saves the publications to database.
+    """
+    sync_stream(zot, "publications", since, by_version, checkpoint)
+
+
+def sync_annotations(
+    zot: zotero.Zotero,
+    since: int,
+    by_version: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+):
     """Fetches items of type 'annotation' which have been updated since the given
     library version.
     Saves the annotations to database.
     """
-    # TODO: use Zotero.follow() or iterfollow() methods
-    # https://pyzotero.readthedocs.io/en/latest/#the-follow-and-everything-methods
-    items = zot.everything(zot.items(itemType="annotation", since=since))
-    n_created = 0
-    n_updated = 0
-    for item in items:
-        key = item["key"]
-        annotation, created = Annotation.objects.get_or_create(zotero_id=key)
-        annotation.content = item
-        annotation.save()
-        if created:
-            n_created += 1
-        else:
-            n_updated += 1
-    logging.info(f"Updated {n_updated} annotations; added {n_created} new annotations.")
+    sync_stream(zot, "annotations", since, by_version, checkpoint)
+
+
+class ConcurrentSync:
+    """Fetches the pages of all item streams concurrently and saves them.
+
+    The HTTP requests run in a pool of worker threads, each with its own
+    Zotero instance (pyzotero instances keep per-request state), but all
+    sharing the HTTP client and thus the connection pool of the given
+    instance. At most `concurrency` requests are in flight at any time.
+    Every response is handed back to the calling thread, which is the only
+    thread that touches the database.
+
+    Since pages may arrive out of order, the checkpoint of a stream is set to
+    the offset of the first page that has not been saved yet.
+    """
+
+    def __init__(
+        self,
+        zot: zotero.Zotero,
+        since: int,
+        by_version: bool,
+        concurrency: int,
+        checkpoints: Optional[Dict[str, Checkpoint]] = None,
+    ):
+        self.zot = zot
+        self.since = since
+        self.by_version = by_version
+        self.concurrency = concurrency
+        self.checkpoints = {} if by_version else (checkpoints or {})
+        # Offsets of the pages that have been requested but not saved
+        self.unsaved: Dict[str, Set[int]] = {stream: set() for stream in STREAMS}
+        self.local = threading.local()
+        # Requests that have not been submitted yet, as (fetch, handler)
+        # pairs; fetch runs in a worker thread and its result is passed to
+        # handler in the calling thread
+        self.queue: Deque[Tuple[Callable[[zotero.Zotero], Any], Callable[[Any], None]]] = deque()
+        self.counts = {stream: [0, 0, 0] for stream in STREAMS}
+
+    def worker_instance(self) -> zotero.Zotero:
+        zot = getattr(self.local, "zot", None)
+        if zot is None:
+            zot = self.local.zot = get_zotero_instance(client=self.zot.client)
+        return zot
+
+    def call(self, fetch: Callable[[zotero.Zotero], Any]) -> Any:
+        return fetch(self.worker_instance())
+
+    def run(self) -> None:
+        for stream in STREAMS:
+            self.start_stream(stream)
+        pending: Dict[Future, Callable[[Any], None]] = {}
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="zoterosync"
+        ) as executor:
+            try:
+                while self.queue or pending:
+                    while self.queue and len(pending) < self.concurrency:
+                        fetch, handler = self.queue.popleft()
+                        pending[executor.submit(self.call, fetch)] = handler
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handler = pending.pop(future)
+                        handler(future.result())
+            finally:
+                for future in pending:
+                    future.cancel()
+        for stream, counts in self.counts.items():
+            log_counts(stream, *counts)
+
+    def start_stream(self, stream: str) -> None:
+        _, fetch = STREAMS[stream]
+        checkpoint = self.checkpoints.get(stream)
+        if self.by_version:
+            self.queue.append((
+                partial(fetch_versions, fetch=fetch, since=self.since),
+                partial(self.handle_versions, stream),
+            ))
+        elif not (checkpoint and checkpoint.completed):
+            start = checkpoint.start if checkpoint else 0
+            self.unsaved[stream].add(start)
+            self.queue.append((
+                partial(fetch_first_page, fetch=fetch, since=self.since, start=start),
+                partial(self.handle_first_page, stream, start),
+            ))
+
+    def handle_first_page(
+        self, stream: str, first: int, result: Tuple[List[dict], int]
+    ) -> None:
+        """Schedules the remaining pages once the total is known."""
+        _, fetch = STREAMS[stream]
+        items, total = result
+        for start in range(first + PAGE_SIZE, total, PAGE_SIZE):
+            self.unsaved[stream].add(start)
+            self.queue.append((
+                partial(fetch_page, fetch=fetch, since=self.since, start=start),
+                partial(self.handle_page, stream, start),
+            ))
+        self.handle_page(stream, first, items)
+
+    def handle_versions(self, stream: str, versions: Dict[str, int]) -> None:
+        """Schedules the download of the outdated items."""
+        model, _ = STREAMS[stream]
+        keys = get_outdated_keys(model, versions)
+        for start in range(0, len(keys), KEYS_PER_REQUEST):
+            self.queue.append((
+                partial(fetch_by_key, keys=keys[start:start + KEYS_PER_REQUEST]),
+                partial(self.handle_page, stream, None),
+            ))
+
+    def handle_page(
+        self, stream: str, start: Optional[int], items: List[dict]
+    ) -> None:
+        """Saves a page of items. If start is given, it is the offset of the
+        page, which is used to update the checkpoint of the stream."""
+        model, _ = STREAMS[stream]
+        checkpoint = self.checkpoints.get(stream)
+        with transaction.atomic():
+            counts = save_items(model, items)
+            if start is not None:
+                unsaved = self.unsaved[stream]
+                unsaved.discard(start)
+                if checkpoint and unsaved:
+                    save_checkpoint(checkpoint, min(unsaved))
+                elif not unsaved:
+                    complete_checkpoint(checkpoint)
+        self.counts[stream] = [
+            n + m for n, m in zip(self.counts[stream], counts)
+        ]
+
+
+def delete_items(model: Type[models.Model], keys: Iterable[str]) -> int:
+    """Deletes the objects of the given sync model with the given Zotero keys.
+    Related objects in the lidia app are removed by the cascade.
+    Returns the number of deleted objects of the sync model itself."""
+    keys = list(keys)
+    n_deleted = 0
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        _, per_model = model.objects.filter(
+            zotero_id__in=keys[start:start + KEYS_PER_QUERY]
+        ).delete()
+        n_deleted += per_model.get(model._meta.label, 0)
+    return n_deleted
+
+
+def get_removed_keys(zot: zotero.Zotero, since: int) -> Set[str]:
+    """Returns the keys of items that have been deleted or moved to the
+    trash since the given library version."""
+    deleted = zot.deleted(since=since)
+    keys = set(deleted.get("items", []))
+    # Trashed items are still present in the library, but they are not
+    # returned by the regular item requests
+    keys.update(zot.trash(since=since, format="versions", limit=None))
+    return keys
+
+
+def mark_siblings_dirty(keys: List[str]) -> None:
+    """Marks the annotations that are in the same attachment as the
+    annotations with the given keys as changed, so that the next populate
+    updates the annotations they continue."""
+    parents = set()
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        parents.update(Annotation.objects.filter(
+            zotero_id__in=keys[start:start + KEYS_PER_QUERY]
+        ).values_list("content__data__parentItem", flat=True))
+    parents.discard(None)
+    parents = list(parents)
+    for start in range(0, len(parents), KEYS_PER_QUERY):
+        Annotation.objects.filter(
+            content__data__parentItem__in=parents[start:start + KEYS_PER_QUERY]
+        ).update(dirty=True)
+
+
+def remove_items(keys: Iterable[str]) -> None:
+    """Removes the publications and annotations with the given keys."""
+    keys = list(keys)
+    mark_siblings_dirty(keys)
+    n_publications = delete_items(Publication, keys)
+    n_annotations = delete_items(Annotation, keys)
+    logger.info(
+        f"Removed {n_publications} publications and {n_annotations} "
+        "annotations that were deleted or trashed."
+    )
+
+
+def sync_deletions(zot: zotero.Zotero, since: int):
+    """Removes publications and annotations that have been deleted or moved
+    to the trash since the given library version.
+    """
+    if since < 0:
+        # Nothing has been synchronized yet, so nothing can be removed
+        return
+    remove_items(get_removed_keys(zot, since))
 
 
 def get_local_library_version(zot: zotero.Zotero):
@@ -92,11 +554,66 @@ def update_local_library_version(zot: zotero.Zotero, version: int):
     sync.save()
 
 
-def sync() -> None:
+def get_checkpoints(
+    zot: zotero.Zotero, since: int, zotero_library_version: int
+) -> Dict[str, Checkpoint]:
+    """Returns a checkpoint for every stream.
+
+    If an earlier sync from the same local library version was interrupted,
+    its checkpoints are returned, so that the sync continues toward the
+    same target version. Item offsets are only stable if no items have been
+    removed from the library in the meantime, so in that case, and if there
+    are no usable checkpoints, new checkpoints are created.
+    """
+    library_id = zot.library_id
+    checkpoints = {
+        c.stream: c for c in Checkpoint.objects.filter(library_id=library_id)
+    }
+    if set(checkpoints) == set(STREAMS) and all(
+        c.since_version == since for c in checkpoints.values()
+    ):
+        target_version = checkpoints["publications"].target_version
+        removed_keys = set()
+        if target_version < zotero_library_version:
+            removed_keys = get_removed_keys(zot, target_version)
+        if not removed_keys:
+            logger.info(
+                f"Continuing interrupted sync toward library version {target_version}."
+            )
+            return checkpoints
+        logger.info(
+            "Items have been removed since the interrupted sync; starting over."
+        )
+        # Items saved by the interrupted sync may be among them
+        remove_items(removed_keys)
+    with transaction.atomic():
+        Checkpoint.objects.filter(library_id=library_id).delete()
+        return {
+            stream: Checkpoint.objects.create(
+                library_id=library_id,
+                stream=stream,
+                since_version=since,
+                target_version=zotero_library_version,
+            )
+            for stream in STREAMS
+        }
+
+
+def sync(by_version: bool = False, concurrency: Optional[int] = None) -> None:
     """
     Synchronize with data on the Zotero server.
+    If by_version is True, download only items of which the version differs
+    from the local version (see sync_stream).
+    If concurrency is larger than 1, pages are requested concurrently with at
+    most this number of requests in flight (see ConcurrentSync).
+    Progress is saved after every page, so that an interrupted sync continues
+    where it left off (see get_checkpoints). The local library version is
+    only updated once all items have been saved.
     """
-    zot = get_zotero_instance()
+    if concurrency is None:
+        concurrency = settings.ZOTERO_SYNC_CONCURRENCY
+    limiter = RateLimiter(concurrency)
+    zot = get_zotero_instance(limiter=limiter)
     zotero_library_version = zot.last_modified_version()
     local_library_version = get_local_library_version(zot)
     logger.info(f"Remote library version: {zotero_library_version}.")
@@ -105,10 +622,33 @@ def sync() -> None:
     else:
         logger.info(f"Local library version: {local_library_version}.")
     if zotero_library_version > local_library_version:
-        sync_publications(zot, since=local_library_version)
-        sync_annotations(zot, since=local_library_version)
-        update_local_library_version(zot, zotero_library_version)
+        checkpoints = get_checkpoints(
+            zot, local_library_version, zotero_library_version
+        )
+        if concurrency > 1:
+            ConcurrentSync(
+                zot, local_library_version, by_version, concurrency, checkpoints
+            ).run()
+        else:
+            sync_publications(
+                zot, local_library_version, by_version, checkpoints["publications"]
+            )
+            sync_annotations(
+                zot, local_library_version, by_version, checkpoints["annotations"]
+            )
+        sync_deletions(zot, since=local_library_version)
+        with transaction.atomic():
+            update_local_library_version(
+                zot, checkpoints["publications"].target_version
+            )
+            Checkpoint.objects.filter(library_id=zot.library_id).delete()
+            bump_generation()
         logger.info("Sync successful")
+        if limiter.n_throttled:
+            logger.info(
+                f"Throttled by the Zotero API {limiter.n_throttled} times, "
+                f"for {limiter.throttled_time:.1f} seconds in total."
+            )
     else:
         logger.info("Local library up to date; not syncing")
 